@@ -0,0 +1,112 @@
+import collections
+import contextlib
+import logging
+import os
+import statistics
+import threading
+import time
+
+GIB = 1024**3
+# Rough per-task resource needs used to size the 'auto' limits.
+BUILD_CPUS = 2
+BUILD_MEMORY = 4 * GIB
+HOOK_MEMORY = 2 * GIB
+MAX_PUSHES = 8
+
+
+def available_memory():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name == 'MemAvailable':
+                    return int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError):
+        return None
+
+
+# Builds run on the docker daemon, which may be remote, so they are sized
+# from the daemon's CPUs and memory; hooks run locally (scanners, func
+# tests) and are sized from this host. Pushes are mostly network bound.
+def auto_limits(daemon_info, cpu_count=None, memory=None):
+    cpu_count = cpu_count or os.cpu_count() or 1
+    daemon_cpus = daemon_info.get('NCPU') or cpu_count
+    daemon_memory = daemon_info.get('MemTotal') or memory
+    builds = max(1, daemon_cpus // BUILD_CPUS)
+    if daemon_memory:
+        builds = max(1, min(builds, daemon_memory // BUILD_MEMORY))
+    hooks = cpu_count
+    if memory:
+        hooks = max(1, min(hooks, memory // HOOK_MEMORY))
+    pushes = max(2, min(MAX_PUSHES, builds * 2))
+    return {'build': builds, 'hook': hooks, 'push': pushes}
+
+
+# A concurrency limit that adjusts itself while the run progresses: it
+# backs off when tasks start taking much longer than is typical (the daemon
+# or host is thrashing), and grows again while tasks are queueing and
+# latency stays close to typical. Tasks of very different sizes (e.g. fully
+# cached and uncached builds) are told apart by a `kind` set on the slot,
+# and each is compared with the median of its own recent durations, so a
+# mix of long and short tasks isn't mistaken for a slowdown.
+class AdaptiveLimiter:
+    SLOW = 1.5
+    HEALTHY = 1.2
+    # Durations kept per kind of task.
+    WINDOW = 20
+    # Samples needed before a kind has a baseline, and between adjustments.
+    RECENT = 5
+
+    def __init__(self, name, limit, minimum=1, maximum=None):
+        self.name = name
+        self.limit = limit
+        self.minimum = minimum
+        self.maximum = maximum or limit * 2
+        self.active = 0
+        self.waiting = 0
+        self._samples = {}
+        # Recent durations relative to their kind's baseline.
+        self._ratios = collections.deque(maxlen=self.RECENT)
+        self._cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def slot(self):
+        with self._cond:
+            self.waiting += 1
+            self._cond.wait_for(lambda: self.active < self.limit)
+            self.waiting -= 1
+            self.active += 1
+        sample = {'kind': None}
+        start = time.monotonic()
+        try:
+            yield sample
+        finally:
+            with self._cond:
+                self.active -= 1
+                self._observe(time.monotonic() - start, sample['kind'])
+                self._cond.notify_all()
+
+    def _observe(self, duration, kind=None):
+        samples = self._samples.setdefault(kind, collections.deque(maxlen=self.WINDOW))
+        if len(samples) >= self.RECENT:
+            self._ratios.append(duration / max(statistics.median(samples), 1e-6))
+        # A lasting slowdown becomes the new baseline once it fills the
+        # window, which stops the limit from being lowered indefinitely.
+        samples.append(duration)
+        if len(self._ratios) < self.RECENT:
+            return
+        ratio = statistics.median(self._ratios)
+        if ratio > self.SLOW and self.limit > self.minimum:
+            self._resize(self.limit - 1, 'latency rising')
+        elif ratio <= self.HEALTHY and self.waiting and self.limit < self.maximum:
+            self._resize(self.limit + 1, f'{self.waiting} waiting')
+
+    def _resize(self, limit, reason):
+        logging.info(f'Adjusting {self.name} concurrency {self.limit} -> {limit} ({reason})')
+        self.limit = limit
+        # Judge the new limit on the tasks that run under it.
+        self._ratios.clear()
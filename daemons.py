@@ -0,0 +1,74 @@
+import contextlib
+import dataclasses
+import logging
+import threading
+
+import docker
+
+
+@dataclasses.dataclass
+class Daemon:
+    name: str
+    client: docker.DockerClient
+    # Environment that points hook scripts' docker commands at this daemon.
+    env: dict
+    active: int = 0
+
+
+def connect(host, pool_size):
+    # DOCKER_HOST style URLs, or the names of docker contexts.
+    if '://' in host:
+        client = docker.DockerClient(base_url=host, max_pool_size=pool_size)
+        return Daemon(host, client, {'DOCKER_HOST': host})
+    context = docker.ContextAPI.get_context(host)
+    if context is None:
+        raise docker.errors.ContextNotFound(host)
+    client = docker.DockerClient(base_url=context.Host, tls=context.TLSConfig, max_pool_size=pool_size)
+    return Daemon(host, client, {'DOCKER_CONTEXT': host})
+
+
+# The docker daemons a run builds on. Each release is assigned the daemon
+# with the fewest releases in progress, and all of its docker calls (build,
+# tag, push, removal) go to that daemon, so images never have to move
+# between daemons.
+class DaemonPool:
+
+    def __init__(self, daemons):
+        self.daemons = daemons
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @classmethod
+    def from_hosts(cls, hosts, pool_size):
+        if not hosts:
+            return cls([Daemon('default', docker.from_env(max_pool_size=pool_size), {})])
+        daemons = [connect(host, pool_size) for host in hosts]
+        logging.info(f'Building on docker daemons: {", ".join(d.name for d in daemons)}')
+        return cls(daemons)
+
+    def current(self):
+        return getattr(self._local, 'daemon', None) or self.daemons[0]
+
+    @contextlib.contextmanager
+    def use(self, daemon=None):
+        with self._lock:
+            if daemon is None:
+                daemon = min(self.daemons, key=lambda d: d.active)
+            daemon.active += 1
+        previous = getattr(self._local, 'daemon', None)
+        self._local.daemon = daemon
+        try:
+            yield daemon
+        finally:
+            self._local.daemon = previous
+            with self._lock:
+                daemon.active -= 1
+
+    # Combined resources, for sizing the concurrency automatically.
+    def info(self):
+        total = {'NCPU': 0, 'MemTotal': 0}
+        for daemon in self.daemons:
+            info = daemon.client.info()
+            for key in total:
+                total[key] += info.get(key) or 0
+        return total
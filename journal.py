@@ -0,0 +1,99 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import threading
+
+
+def context_files(path, exclude=()):
+    # In a git checkout only tracked files count, so that the journal, logs
+    # and other run output in the working directory don't change the digest.
+    try:
+        proc = subprocess.run(['git', 'ls-files', '-z'], cwd=path, capture_output=True, check=True)
+        return sorted(f for f in proc.stdout.decode().split('\0') if f)
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    exclude = {os.path.abspath(e) for e in exclude}
+    files = []
+    for root, dirs, names in os.walk(path):
+        dirs[:] = [d for d in dirs if d != '.git']
+        for name in names:
+            file_path = os.path.join(root, name)
+            if os.path.abspath(file_path) not in exclude:
+                files.append(os.path.relpath(file_path, path))
+    return sorted(files)
+
+
+# Hash of everything that goes into an image other than the build args: the
+# contents of the build context.
+def context_digest(path='.', exclude=()):
+    digest = hashlib.sha256()
+    for name in context_files(path, exclude):
+        digest.update(name.encode() + b'\0')
+        try:
+            with open(os.path.join(path, name), 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+        except OSError:
+            pass
+    return digest.hexdigest()
+
+
+def inputs_digest(context, dockerfile, buildargs):
+    data = json.dumps({'context': context, 'dockerfile': dockerfile, 'buildargs': buildargs}, sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+# Append-only JSON-lines record of the completed steps of a run (build,
+# post_build, push and post_push), keyed by version, repository and tag and
+# by a digest of the build inputs. When resuming, steps recorded for the
+# same inputs (and the same image) are skipped.
+class Journal:
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self._lock = threading.Lock()
+        self._done = {}
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line of an interrupted run may be torn.
+                        continue
+                    self._done[self._key(entry)] = entry
+            logging.info(f'Resuming with {len(self._done)} completed steps from {path}')
+        self._file = open(path, 'a')
+
+    @staticmethod
+    def _key(entry):
+        return entry['step'], entry['version'], entry.get('repo'), entry.get('tag'), entry['inputs']
+
+    def done(self, step, version, inputs, image=None, repo=None, tag=None):
+        entry = self._done.get((step, version, repo, tag, inputs))
+        if entry is None or (image is not None and entry.get('image') != image):
+            return None
+        return entry
+
+    def record(self, step, version, inputs, image=None, repo=None, tag=None):
+        entry = {
+            'step': step,
+            'version': version,
+            'repo': repo,
+            'tag': tag,
+            'inputs': inputs,
+            'image': image,
+            'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        }
+        with self._lock:
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._done[self._key(entry)] = entry
+
+    def close(self):
+        with self._lock:
+            self._file.close()
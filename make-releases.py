@@ -5,39 +5,186 @@ import math
 import sys
 import subprocess
 
-from releasemanager import ReleaseManager, str2bool
+import snyk
 
+from metrics import Metrics
+from profiling import Profiler
+from releasemanager import DEFAULT_GC_HIGH_WATER, DEFAULT_PROBE_LIMIT, ReleaseManager, enable_http_cache, read_plan, read_variants, str2bool, write_plan
+from timing import events
 
-def parse_args():
-    parser = argparse.ArgumentParser(description='Manage docker releases')
-    parser.add_argument('--create', dest='create', action='store_true')
-    parser.add_argument('--update', dest='update', action='store_true')
-    parser.add_argument('--create-eap', dest='create_eap', action='store_true')
 
-    parser.add_argument('--start-version', dest='start_version', required=True)
-    parser.add_argument('--end-version', dest='end_version', default=math.inf)
-    parser.add_argument('--docker-repos', dest='docker_repos', required=True,
-                        help='A comma-separated list of repositories to push to.')
+def concurrency(value):
+    if value == 'auto':
+        return value
+    return int(value)
+
+
+def parent_parsers(suppress=False):
+    # Options describing what to build; used by plain runs and by 'plan'.
+    build = argparse.ArgumentParser(add_help=False)
+    build.add_argument('--create', dest='create', action='store_true')
+    build.add_argument('--update', dest='update', action='store_true')
+    build.add_argument('--create-eap', dest='create_eap', action='store_true')
+    build.add_argument('--sync-aliases', dest='sync_aliases', action='store_true',
+                       help='Move alias tags that point at the wrong image, and build only unpublished versions.')
+
+    build.add_argument('--start-version', dest='start_version')
+    build.add_argument('--end-version', dest='end_version', default=math.inf)
+    build.add_argument('--docker-repos', dest='docker_repos',
+                       help='A comma-separated list of repositories to push to.')
+
+    build.add_argument('--dockerfile-version-arg', dest='dockerfile_version_arg')
+    build.add_argument('--product-key', '--mac-product-key', dest='product_key')
+
+    build.add_argument('--default-release', dest='default_release', action='store_true')
+    build.add_argument('--dockerfile', dest='dockerfile', default='Dockerfile')
+    build.add_argument('--dockerfile-buildargs', dest='dockerfile_buildargs')
+
+    build.add_argument('--job-offset', dest='job_offset', type=int, default=None)
+    build.add_argument('--jobs-total', dest='jobs_total', type=int, default=None)
+
+    build.add_argument('--tag-suffixes', dest='tag_suffixes')
+    build.add_argument('--variants', dest='variants', default=None,
+                       help='A JSON file listing image variants to build together, each with its own '
+                            'dockerfile, dockerfile_buildargs, tag_suffixes and default_release.')
+    build.add_argument('--manifest-probe-limit', dest='manifest_probe_limit', type=int, default=DEFAULT_PROBE_LIMIT,
+                       help='Check up to this many candidate tags with manifest HEAD requests instead of '
+                            'listing every tag in the repositories (0 always lists).')
+
+    # Options controlling how builds are run; used by plain runs and by 'execute'.
+    runtime = argparse.ArgumentParser(add_help=False)
+    runtime.add_argument('--concurrent-builds', dest='concurrent_builds', type=concurrency, default=1,
+                         help='Number of concurrent builds, or "auto" to size and adjust the build, hook and '
+                              'push concurrency from the host and docker daemon resources.')
+    runtime.add_argument('--docker-hosts', dest='docker_hosts', default=None,
+                         help='A comma-separated list of docker daemons (DOCKER_HOST URLs or context names) '
+                              'to spread the builds across (default: the environment\'s daemon).')
+    runtime.add_argument('--post-build-hook', dest='post_build_hook', default='/usr/src/app/post_build.sh')
+
+    runtime.add_argument('--push', dest='push_docker', action='store_true')
+    runtime.add_argument('--post-push-hook', dest='post_push_hook', default='/usr/src/app/post_push.sh')
+
+    runtime.add_argument('--hook-timeout', dest='hook_timeout', type=float, default=None, metavar='SECONDS',
+                         help='Kill a hook, and everything it started, if it runs for longer than this.')
+    runtime.add_argument('--post-build-hook-timeout', dest='post_build_hook_timeout', type=float, default=None,
+                         metavar='SECONDS', help='Timeout for the post-build hook (default: --hook-timeout).')
+    runtime.add_argument('--post-push-hook-timeout', dest='post_push_hook_timeout', type=float, default=None,
+                         metavar='SECONDS', help='Timeout for the post-push hook (default: --hook-timeout).')
+    runtime.add_argument('--hook-log-dir', dest='hook_log_dir', default=None,
+                         help='Write the output of the hooks to a log file per version in this directory.')
+
+    runtime.add_argument('--gc-images', dest='gc_images', action='store_true',
+                         help='Remove each version\'s local images once it has been pushed.')
+    runtime.add_argument('--gc-high-water', dest='gc_high_water', type=float,
+                         default=DEFAULT_GC_HIGH_WATER / 1024**3, metavar='GB',
+                         help='With --gc-images, prune dangling image layers whenever the docker daemon\'s '
+                              'image storage exceeds this size (default: %(default)s).')
 
-    parser.add_argument('--dockerfile-version-arg', dest='dockerfile_version_arg', required=True)
-    parser.add_argument('--product-key', '--mac-product-key', dest='product_key', required=True)
+    runtime.add_argument('--keep-going', dest='keep_going', action='store_true',
+                         help='Carry on with the other versions when one fails, and fail at the end.')
+    runtime.add_argument('--failure-report', dest='failure_report', default=None,
+                         help='With --keep-going, write a JSON report of the failed versions to this file.')
 
-    parser.add_argument('--concurrent-builds', dest='concurrent_builds', type=int, default=1)
-    parser.add_argument('--default-release', dest='default_release', action='store_true')
-    parser.add_argument('--dockerfile', dest='dockerfile', default='Dockerfile')
-    parser.add_argument('--dockerfile-buildargs', dest='dockerfile_buildargs')
-    parser.add_argument('--post-build-hook', dest='post_build_hook', default='/usr/src/app/post_build.sh')
+    runtime.add_argument('--journal', dest='journal', default=None,
+                         help='Append each completed build, hook and push step to this JSON-lines journal.')
+    runtime.add_argument('--resume', dest='resume', action='store_true',
+                         help='Skip the steps the --journal records as done for the same inputs.')
 
-    parser.add_argument('--push', dest='push_docker', action='store_true')
-    parser.add_argument('--post-push-hook', dest='post_push_hook', default='/usr/src/app/post_push.sh')
+    runtime.add_argument('--event-log', dest='event_log', default=None,
+                         help='Append per-stage timing events to this JSON-lines file.')
+    runtime.add_argument('--metrics-file', dest='metrics_file', default=None,
+                         help='Write OpenMetrics counters and histograms for the run to this file.')
+    runtime.add_argument('--metrics-port', dest='metrics_port', type=int, default=None,
+                         help='Serve OpenMetrics on this local port while the run is in progress.')
+    runtime.add_argument('--profile', dest='profile', nargs='?', const='release-maker-profile', default=None,
+                         metavar='PREFIX',
+                         help='Run under cProfile and write PREFIX.pstats and a PREFIX.collapsed span flame graph.')
 
-    parser.add_argument('--job-offset', dest='job_offset', type=int, default=None)
-    parser.add_argument('--jobs-total', dest='jobs_total', type=int, default=None)
+    # The subcommands' copies of the options must not default anything:
+    # argparse applies a subparser's defaults over the values already parsed
+    # by the main parser, which would drop options given before the command.
+    if suppress:
+        for parent in (build, runtime):
+            for action in parent._actions:
+                action.default = argparse.SUPPRESS
+    return build, runtime
 
-    parser.add_argument('--tag-suffixes', dest='tag_suffixes')
 
+def build_parser():
+    build, runtime = parent_parsers()
+    parser = argparse.ArgumentParser(description='Manage docker releases', parents=[build, runtime])
+    build, runtime = parent_parsers(suppress=True)
+    commands = parser.add_subparsers(dest='command', metavar='{plan,execute,watch,snyk-untag}',
+                                     help='Without a command, discover and build in one run.')
+
+    plan = commands.add_parser('plan', parents=[build],
+                               help='Run discovery once and write a build plan; doubles as a dry run.')
+    plan.add_argument('--output', dest='output', default='release-plan.json',
+                      help='Where to write the plan (default: release-plan.json).')
+
+    execute = commands.add_parser('execute', parents=[runtime],
+                                  help='Build one shard of a plan written by "plan", skipping discovery.')
+    execute.add_argument('--plan', dest='plan', required=True)
+    execute.add_argument('--shard', dest='shard', type=int, default=None,
+                         help='The shard to build (default: all of them).')
+
+    watch = commands.add_parser('watch', parents=[build, runtime],
+                                help='Keep polling for new versions and build them as they appear.')
+    watch.add_argument('--interval', dest='interval', type=float, default=300,
+                       help='Seconds between polls (default: %(default)s).')
+    watch.add_argument('--iterations', dest='iterations', type=int, default=None,
+                       help='Stop after this many polls (default: run until stopped).')
+
+    untag = commands.add_parser('snyk-untag',
+                                help='Remove the team tag from the Snyk projects of end-of-life images.')
+    untag.add_argument('--token', dest='token', default=os.environ.get('SNYK_TOKEN'),
+                       help='Snyk API token (default: $SNYK_TOKEN).')
+    untag.add_argument('--org-id', dest='org_id', required=True)
+    untag.add_argument('--project', dest='project', default=None,
+                       help='Only untag this product family (default: all of them).')
+    untag.add_argument('--regex-tag', dest='regex_tag', default=None,
+                       help='Only untag image tags matching this regular expression.')
+    untag.add_argument('--before-version', dest='before_version', default=None,
+                       help='Only untag version tags older than this version.')
+    untag.add_argument('--tag-key', dest='tag_key', default='team-name')
+    untag.add_argument('--tag-value', dest='tag_value', default='dc-deployment')
+    untag.add_argument('--yes', dest='yes', action='store_true',
+                       help='Untag without asking for confirmation.')
+    untag.add_argument('--snyk-api', dest='snyk_api', default=snyk.SNYK_API)
+    untag.add_argument('--concurrency', dest='concurrency', type=int, default=snyk.SNYK_CONCURRENCY)
+    untag.add_argument('--rate', dest='rate', type=float, default=snyk.SNYK_RATE,
+                       help='Maximum Snyk API requests per second (default: %(default)s).')
+
+    return parser
+
+
+def parse_args():
+    parser = build_parser()
     args = parser.parse_args()
-    if args.tag_suffixes is not None:
+    if args.command == 'snyk-untag':
+        if args.token is None:
+            parser.error('the following arguments are required: --token')
+        try:
+            snyk.projects_for(args.project)
+        except ValueError as exc:
+            parser.error(str(exc))
+    elif args.command != 'execute':
+        for option, dest in [('--start-version', 'start_version'), ('--docker-repos', 'docker_repos'),
+                             ('--dockerfile-version-arg', 'dockerfile_version_arg'),
+                             ('--product-key', 'product_key')]:
+            if getattr(args, dest) is None:
+                parser.error(f'the following arguments are required: {option}')
+    if args.command in ('plan', 'watch') and args.sync_aliases:
+        parser.error(f'--sync-aliases cannot be used with {args.command}')
+    if args.command in ('plan', 'watch') and args.variants is not None:
+        parser.error(f'--variants cannot be used with {args.command}')
+    if args.variants is not None and args.sync_aliases:
+        parser.error('--variants cannot be used with --sync-aliases')
+    if args.command == 'watch' and args.update:
+        parser.error('--update cannot be used with watch')
+    if getattr(args, 'resume', False) and args.journal is None:
+        parser.error('--resume requires --journal')
+    if getattr(args, 'tag_suffixes', None) is not None:
         args.tag_suffixes = args.tag_suffixes.split(',')
 
     return args
@@ -46,6 +193,111 @@ def parse_args():
 def main(args):
     logging.basicConfig(level=logging.INFO)
 
+    command = getattr(args, 'command', None)
+    if command == 'snyk-untag':
+        snyk.untag(args)
+        return
+    if command == 'plan':
+        write_plan(plan(args), args.output)
+        return
+    if command == 'execute':
+        args.plan = read_plan(args.plan)
+        args.product_key = args.plan['config']['product_key']
+
+    event_log = getattr(args, 'event_log', None)
+    if event_log is not None:
+        events.open(event_log)
+    metrics_file = getattr(args, 'metrics_file', None)
+    metrics_port = getattr(args, 'metrics_port', None)
+    metrics = None
+    if metrics_file is not None or metrics_port is not None:
+        metrics = Metrics(product=args.product_key)
+        events.add_listener(metrics.observe_event)
+        if metrics_port is not None:
+            metrics.serve(metrics_port)
+    profile = getattr(args, 'profile', None)
+    profiler = Profiler() if profile is not None else None
+    try:
+        if profiler is not None:
+            profiler.run(run, args, profiler)
+        else:
+            run(args)
+    finally:
+        logging.info(f'Run summary:\n{events.summary()}')
+        events.close()
+        if metrics_file is not None:
+            metrics.write(metrics_file)
+        if profiler is not None:
+            profiler.write(profile, events)
+
+
+def plan(args):
+    manager = ReleaseManager(start_version=args.start_version,
+                             end_version=args.end_version,
+                             concurrent_builds=1,
+                             default_release=args.default_release,
+                             docker_repos=args.docker_repos.split(','),
+                             dockerfile=args.dockerfile,
+                             dockerfile_buildargs=args.dockerfile_buildargs,
+                             dockerfile_version_arg=args.dockerfile_version_arg,
+                             product_key=args.product_key,
+                             tag_suffixes=args.tag_suffixes,
+                             push_docker=False,
+                             post_build_hook=None,
+                             post_push_hook=None,
+                             jobs_total=args.jobs_total,
+                             manifest_probe_limit=args.manifest_probe_limit)
+    return manager.plan_releases(create=args.create, update=args.update, create_eap=args.create_eap)
+
+
+def hook_timeouts(args):
+    timeouts = {}
+    for hook in ('post_build', 'post_push'):
+        timeout = getattr(args, f'{hook}_hook_timeout', None)
+        if timeout is None:
+            timeout = getattr(args, 'hook_timeout', None)
+        if timeout is not None:
+            timeouts[hook] = timeout
+    return timeouts
+
+
+# ReleaseManager options that only affect how the builds are run.
+def runtime_options(args):
+    hosts = getattr(args, 'docker_hosts', None)
+    high_water = getattr(args, 'gc_high_water', None)
+    return {
+        'docker_hosts': hosts.split(',') if hosts else None,
+        'gc_images': getattr(args, 'gc_images', False),
+        'gc_high_water': DEFAULT_GC_HIGH_WATER if high_water is None else int(high_water * 1024**3),
+        'journal': getattr(args, 'journal', None),
+        'resume': getattr(args, 'resume', False),
+        'keep_going': getattr(args, 'keep_going', False),
+        'hook_timeouts': hook_timeouts(args),
+        'hook_log_dir': getattr(args, 'hook_log_dir', None),
+    }
+
+
+def execute(args, profiler=None):
+    manager = ReleaseManager(**args.plan['config'],
+                             concurrent_builds=args.concurrent_builds,
+                             push_docker=args.push_docker,
+                             post_build_hook=args.post_build_hook,
+                             post_push_hook=args.post_push_hook,
+                             job_offset=args.shard,
+                             jobs_total=args.plan['jobs_total'],
+                             plan=args.plan,
+                             **runtime_options(args))
+    manager.profiler = profiler
+    manager.execute_plan()
+    manager.check_failures(getattr(args, 'failure_report', None))
+
+
+def run(args, profiler=None):
+    if getattr(args, 'command', None) == 'execute':
+        return execute(args, profiler)
+    if getattr(args, 'command', None) == 'watch':
+        enable_http_cache()
+
     manager = ReleaseManager(start_version=args.start_version,
                              end_version=args.end_version,
                              concurrent_builds=args.concurrent_builds,
@@ -60,13 +312,29 @@ def main(args):
                              post_build_hook=args.post_build_hook,
                              post_push_hook=args.post_push_hook,
                              job_offset=args.job_offset,
-                             jobs_total=args.jobs_total)
+                             jobs_total=args.jobs_total,
+                             manifest_probe_limit=getattr(args, 'manifest_probe_limit', DEFAULT_PROBE_LIMIT),
+                             **runtime_options(args))
+    manager.profiler = profiler
+    if getattr(args, 'command', None) == 'watch':
+        # Without --create-eap, watch for new releases by default.
+        manager.watch(args.interval, create=args.create or not args.create_eap,
+                      create_eap=args.create_eap, iterations=args.iterations)
+        return
+    if getattr(args, 'variants', None) is not None:
+        manager.release_variants(read_variants(args.variants), create=args.create, update=args.update,
+                                 create_eap=args.create_eap)
+        manager.check_failures(getattr(args, 'failure_report', None))
+        return
     if args.create:
         manager.create_releases()
     if args.update:
         manager.update_releases()
     if args.create_eap:
         manager.create_eap_releases()
+    if getattr(args, 'sync_aliases', False):
+        manager.sync_aliases()
+    manager.check_failures(getattr(args, 'failure_report', None))
 
 if __name__ == '__main__':
     args = parse_args()
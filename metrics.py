@@ -0,0 +1,170 @@
+import bisect
+import http.server
+import logging
+import os
+import threading
+import time
+
+
+HTTP_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+HOOK_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+BUILD_BUCKETS = (10, 30, 60, 120, 300, 600, 900, 1200, 1800, 3600)
+PUSH_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600)
+
+# name: (type, help, buckets)
+FAMILIES = {
+    'release_maker_builds': ('counter', 'Image builds attempted, by outcome.', None),
+    'release_maker_build_duration_seconds': ('histogram', 'Duration of image builds.', BUILD_BUCKETS),
+    'release_maker_build_cache_hits': ('counter', 'Dockerfile steps satisfied from the build cache.', None),
+    'release_maker_build_steps': ('counter', 'Dockerfile steps executed or restored from cache.', None),
+    'release_maker_pushes': ('counter', 'Image tag pushes attempted, by outcome.', None),
+    'release_maker_push_duration_seconds': ('histogram', 'Duration of image tag pushes.', PUSH_BUCKETS),
+    'release_maker_push_bytes': ('counter', 'Bytes sent to the registry by image pushes.', None),
+    'release_maker_hooks': ('counter', 'Hook script runs, by hook and outcome.', None),
+    'release_maker_hook_duration_seconds': ('histogram', 'Duration of hook script runs.', HOOK_BUCKETS),
+    'release_maker_hook_timeouts': ('counter', 'Hook script runs killed for exceeding the hook timeout.', None),
+    'release_maker_http_requests': ('counter', 'Discovery HTTP requests, by endpoint and outcome.', None),
+    'release_maker_http_request_duration_seconds': ('histogram', 'Duration of discovery HTTP requests.', HTTP_BUCKETS),
+    'release_maker_http_response_bytes': ('counter', 'Bytes received by discovery HTTP requests.', None),
+    'release_maker_http_cache_hits': ('counter', 'Discovery HTTP requests answered with 304 Not Modified.', None),
+    'release_maker_retries': ('counter', 'Retried attempts, by stage.', None),
+    'release_maker_versions_considered': ('counter', 'Candidate versions checked against the registry.', None),
+    'release_maker_versions_skipped': ('counter', 'Candidate versions skipped as already published.', None),
+    'release_maker_gc_reclaimed_bytes': ('counter', 'Bytes reclaimed by pruning dangling image layers.', None),
+    'release_maker_last_run_timestamp_seconds': ('gauge', 'Unix time at which the metrics were last written.', None),
+}
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = ((k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for k, v in sorted(labels))
+    pairs = ','.join(f'{k}="{v}"' for k, v in escaped)
+    return '{' + pairs + '}'
+
+
+class Metrics:
+
+    def __init__(self, **const_labels):
+        self.const_labels = const_labels
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted({**self.const_labels, **labels}.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted({**self.const_labels, **labels}.items())))
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, name, value, **labels):
+        buckets = FAMILIES[name][2]
+        key = (name, tuple(sorted({**self.const_labels, **labels}.items())))
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(buckets), 0.0, 0))
+            counts = list(counts)
+            for i in range(bisect.bisect_left(buckets, value), len(buckets)):
+                counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def get(self, name, **labels):
+        key = (name, tuple(sorted({**self.const_labels, **labels}.items())))
+        return self._values.get(key)
+
+    # Listener for timing.EventLog; every metric is derived from the stage
+    # events so that there is a single instrumentation point in the code.
+    def observe_event(self, event):
+        stage = event['stage']
+        outcome = 'failure' if 'error' in event else 'success'
+        if event.get('retries'):
+            self.inc('release_maker_retries', stage=stage)
+        if stage.startswith('discovery.'):
+            endpoint = stage.partition('.')[2]
+            self.inc('release_maker_http_requests', endpoint=endpoint, outcome=outcome)
+            self.observe('release_maker_http_request_duration_seconds', event['duration'], endpoint=endpoint)
+            self.inc('release_maker_http_response_bytes', event.get('bytes', 0), endpoint=endpoint)
+            if event.get('cached'):
+                self.inc('release_maker_http_cache_hits', endpoint=endpoint)
+        elif stage == 'build':
+            self.inc('release_maker_builds', outcome=outcome)
+            self.observe('release_maker_build_duration_seconds', event['duration'])
+            self.inc('release_maker_build_cache_hits', event.get('cache_hits', 0))
+            self.inc('release_maker_build_steps', event.get('steps', 0))
+        elif stage == 'push':
+            self.inc('release_maker_pushes', outcome=outcome)
+            self.observe('release_maker_push_duration_seconds', event['duration'])
+            self.inc('release_maker_push_bytes', event.get('bytes', 0))
+        elif stage.startswith('hook.'):
+            hook = stage.partition('.')[2]
+            self.inc('release_maker_hooks', hook=hook, outcome=outcome)
+            self.observe('release_maker_hook_duration_seconds', event['duration'], hook=hook)
+            if event.get('timed_out'):
+                self.inc('release_maker_hook_timeouts', hook=hook)
+        elif stage == 'gc.prune':
+            self.inc('release_maker_gc_reclaimed_bytes', event.get('bytes', 0))
+        elif stage == 'unbuilt_versions':
+            self.inc('release_maker_versions_considered', event.get('candidates', 0))
+            self.inc('release_maker_versions_skipped', event.get('skipped', 0))
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        lines = []
+        for name, (mtype, text, buckets) in FAMILIES.items():
+            series = sorted((labels, value) for (n, labels), value in values.items() if n == name)
+            if not series:
+                continue
+            lines.append(f'# TYPE {name} {mtype}')
+            lines.append(f'# HELP {name} {text}')
+            for labels, value in series:
+                if mtype == 'counter':
+                    lines.append(f'{name}_total{_labels(labels)} {value}')
+                elif mtype == 'gauge':
+                    lines.append(f'{name}{_labels(labels)} {value}')
+                else:
+                    counts, total, count = value
+                    for le, bucket_count in zip(buckets, counts):
+                        lines.append(f'{name}_bucket{_labels(labels + (("le", float(le)),))} {bucket_count}')
+                    lines.append(f'{name}_bucket{_labels(labels + (("le", "+Inf"),))} {count}')
+                    lines.append(f'{name}_sum{_labels(labels)} {total}')
+                    lines.append(f'{name}_count{_labels(labels)} {count}')
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        # Written atomically so that a textfile collector never reads a
+        # partially written file.
+        self.set('release_maker_last_run_timestamp_seconds', time.time())
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+        logging.info(f'Wrote run metrics to {path}')
+
+    def serve(self, port, host='127.0.0.1'):
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/openmetrics-text; version=1.0.0; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(f'Metrics request: {format % args}')
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        logging.info(f'Serving metrics on http://{host}:{server.server_address[1]}/metrics')
+        return server
@@ -0,0 +1,53 @@
+import cProfile
+import functools
+import logging
+import pstats
+import threading
+
+
+class Profiler:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._profiles = []
+
+    def _profile(self, fn, *args, **kwargs):
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(fn, *args, **kwargs)
+        finally:
+            with self._lock:
+                self._profiles.append(profile)
+
+    def run(self, fn, *args, **kwargs):
+        return self._profile(fn, *args, **kwargs)
+
+    # cProfile only sees the thread it was enabled on, so work handed to
+    # the build thread pool has to be wrapped to get its own profile; all
+    # of them are merged when the stats are written.
+    def wrap(self, fn):
+        @functools.wraps(fn)
+        def profiled(*args, **kwargs):
+            return self._profile(fn, *args, **kwargs)
+        return profiled
+
+    def stats(self):
+        with self._lock:
+            profiles = list(self._profiles)
+        if not profiles:
+            return None
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+
+    def write(self, prefix, event_log):
+        stats = self.stats()
+        if stats is not None:
+            stats.dump_stats(f'{prefix}.pstats')
+            logging.info(f'Wrote profile statistics to {prefix}.pstats')
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(25)
+        with open(f'{prefix}.collapsed', 'w') as f:
+            for line in event_log.collapsed_stacks():
+                f.write(line + '\n')
+        logging.info(f'Wrote span flame-graph stacks to {prefix}.collapsed')
@@ -1,10 +1,18 @@
+import collections
 import concurrent.futures
+import contextlib
+import copy
 import dataclasses
+import datetime
 from enum import IntEnum
 import json
 import logging
 import re
+import signal
+import sys
+import threading
 import time
+import urllib.parse
 import xml.etree.ElementTree as xmltree
 
 import docker
@@ -12,10 +20,17 @@ import requests
 import subprocess
 import os
 
+from concurrency import AdaptiveLimiter, auto_limits, available_memory
+from daemons import DaemonPool
+from journal import Journal, context_digest, inputs_digest
+from timing import events
+
 class Registry:
+    SCHEME = "https"
     DOCKER_REGISTRY = "docker-public.packages.atlassian.com"
-    USERNAME = os.environ['DOCKER_BOT_USERNAME']
-    PASSWORD = os.environ['DOCKER_BOT_PASSWORD']
+    # Taken from DOCKER_BOT_USERNAME/DOCKER_BOT_PASSWORD when unset.
+    USERNAME = None
+    PASSWORD = None
 
 class EnvironmentException(Exception):
     pass
@@ -25,6 +40,14 @@ class TestFailedException(Exception):
     pass
 
 
+class ReleaseFailedException(Exception):
+    pass
+
+
+class HookTimeoutException(TestFailedException):
+    pass
+
+
 class VersionType(IntEnum):
      MILESTONE = 0
      BETA = 1
@@ -63,37 +86,204 @@ class Version:
 @dataclasses.dataclass
 class TargetRepo:
     repo: str
-    existing_tags: set[str]
+    # Fetched on demand; see ReleaseManager._listed_tags().
+    existing_tags: set[str] = None
+
+
+@dataclasses.dataclass
+class PlannedBuild:
+    version: str
+    tags: list[str]
+    test_candidate: bool
+    is_prerelease: bool
+    shard: int
+
+
+PLAN_FORMAT = 1
+
+# Above this many (tag, repository) checks unbuilt_versions() lists all
+# tags instead of probing the candidates individually.
+DEFAULT_PROBE_LIMIT = 200
+
+
+def write_plan(plan, path):
+    with open(path, 'w') as f:
+        json.dump(plan, f, indent=2)
+    logging.info(f'Wrote build plan for {len(plan["builds"])} releases to {path}')
+
+
+def read_plan(path):
+    with open(path) as f:
+        plan = json.load(f)
+    if plan.get('format') != PLAN_FORMAT:
+        raise EnvironmentException(f"Plan '{path}' has unsupported format {plan.get('format')}")
+    return plan
+
+
+# The per-variant settings of a --variants file; anything not given is
+# taken from the command line.
+VARIANT_FIELDS = ('dockerfile', 'dockerfile_buildargs', 'tag_suffixes', 'default_release')
+
+
+def read_variants(path):
+    with open(path) as f:
+        variants = json.load(f)
+    if not isinstance(variants, list) or not variants:
+        raise EnvironmentException(f"Variants file '{path}' must contain a non-empty list")
+    for variant in variants:
+        unknown = set(variant) - set(VARIANT_FIELDS)
+        if unknown:
+            raise EnvironmentException(f"Unknown variant settings in '{path}': {', '.join(sorted(unknown))}")
+    return variants
+
+
+# Registry calls share a pooled session so that concurrent manifest probes
+# reuse connections rather than opening one per request.
+PROBE_CONCURRENCY = 16
+registry_session = requests.Session()
+registry_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=PROBE_CONCURRENCY))
+registry_session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=PROBE_CONCURRENCY))
+
+MANIFEST_TYPES = ', '.join([
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.oci.image.manifest.v1+json',
+])
+
+
+# Remembers the validators (ETag/Last-Modified) and body of each discovery
+# response, so that repeated polls can use conditional requests and the
+# servers can answer '304 Not Modified' rather than resend everything.
+class ConditionalCache:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._responses = {}
+
+    def get(self, session, url, params=None, headers=None):
+        key = (url, tuple(sorted((params or {}).items())))
+        with self._lock:
+            cached = self._responses.get(key)
+        headers = dict(headers or {})
+        if cached is not None:
+            if cached.headers.get('ETag'):
+                headers['If-None-Match'] = cached.headers['ETag']
+            if cached.headers.get('Last-Modified'):
+                headers['If-Modified-Since'] = cached.headers['Last-Modified']
+        r = session.get(url, params=params, headers=headers)
+        if r.status_code == requests.codes.not_modified and cached is not None:
+            return cached, True
+        if r.ok and (r.headers.get('ETag') or r.headers.get('Last-Modified')):
+            with self._lock:
+                self._responses[key] = r
+        return r, False
+
+
+# Only used by long-running watch mode; see enable_http_cache().
+http_cache = None
+
+
+def enable_http_cache():
+    global http_cache
+    if http_cache is None:
+        http_cache = ConditionalCache()
+
+
+def http_get(url, event, session=requests, params=None, headers=None):
+    if http_cache is None:
+        r, cached = session.get(url, params=params, headers=headers), False
+    else:
+        r, cached = http_cache.get(session, url, params, headers)
+    event['bytes'] = 0 if cached else len(r.content)
+    if cached:
+        event['cached'] = True
+    return r
+
+
+# The credentials are read when first needed, so that commands that can do
+# without them (e.g. snyk-untag) don't require them; without credentials
+# the registry is queried anonymously.
+def registry_url(path):
+    username = Registry.USERNAME or os.environ.get('DOCKER_BOT_USERNAME')
+    password = Registry.PASSWORD or os.environ.get('DOCKER_BOT_PASSWORD')
+    auth = f'{username}:{password}@' if username and password else ''
+    return f'{Registry.SCHEME}://{auth}{Registry.DOCKER_REGISTRY}{path}'
 
 
 def existing_tags(repo):
     logging.info(f'Retrieving Docker tags for {repo}')
-    r = requests.get(f'https://{Registry.USERNAME}:{Registry.PASSWORD}@{Registry.DOCKER_REGISTRY}/v2/{repo}/tags/list')
+    url = registry_url(f'/v2/{repo}/tags/list')
+    tags = set()
+    page = 1
+    # Registries may paginate the listing; follow the 'next' links.
+    while url is not None:
+        with events.span('discovery.tags', repo=repo, page=page) as event:
+            r = http_get(url, event, session=registry_session)
+        if r.status_code == requests.codes.not_found:
+            return set()
+        tag_data = r.json()
+        tags |= {t for t in tag_data["tags"] or []}
+        next_link = r.links.get('next')
+        url = urllib.parse.urljoin(url, next_link['url']) if next_link else None
+        page += 1
+    return tags
+
+# Returns the digest behind a tag, or None if the tag does not exist.
+def manifest_digest(repo, tag):
+    with events.span('discovery.manifest', repo=repo, tag=tag):
+        r = registry_session.head(registry_url(f'/v2/{repo}/manifests/{tag}'),
+                                  headers={'Accept': MANIFEST_TYPES})
     if r.status_code == requests.codes.not_found:
+        return None
+    r.raise_for_status()
+    return r.headers.get('Docker-Content-Digest', '')
+
+
+# Check just the given tags with concurrent manifest HEAD requests, rather
+# than listing every tag in the repository.
+def probe_tags(repo, tags):
+    tags = list(tags)
+    if not tags:
         return set()
-    tag_data = r.json()
-    tags = {t for t in tag_data["tags"]}
-    return tags
+    logging.info(f'Probing {len(tags)} tags in {repo}')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=PROBE_CONCURRENCY) as executor:
+        digests = executor.map(lambda tag: manifest_digest(repo, tag), tags)
+        return {tag for tag, digest in zip(tags, digests) if digest is not None}
+
+
+# Point a tag at the image behind another tag in the same repository by
+# copying its manifest; nothing is pulled, built or pushed.
+def retag(repo, source, tag):
+    r = registry_session.get(registry_url(f'/v2/{repo}/manifests/{source}'), headers={'Accept': MANIFEST_TYPES})
+    r.raise_for_status()
+    put = registry_session.put(registry_url(f'/v2/{repo}/manifests/{tag}'), data=r.content,
+                               headers={'Content-Type': r.headers['Content-Type']})
+    put.raise_for_status()
+
 
 def get_targets(repos):
-    logging.info(f'Retrieving Docker tags for {repos}')
-    targets = map(lambda repo: TargetRepo(repo, existing_tags(repo)), repos)
-    return list(targets)
+    return [TargetRepo(repo) for repo in repos]
 
 
 def release_filter(version):
     return all(d.isdigit() for d in version.split('.'))
 
 
+MAC_URL = 'https://marketplace.atlassian.com'
+EAP_FEED_URL = 'https://my.atlassian.com/download/feeds/eap'
+PAC_URL = 'https://packages.atlassian.com/maven-external/com/atlassian'
+
+
 def fetch_mac_versions(product_key):
-    mac_url = 'https://marketplace.atlassian.com'
     request_url = f'/rest/2/products/key/{product_key}/versions'
     params = {'offset': 0, 'limit': 50}
     versions = set()
     page = 1
     while True:
         logging.info(f'Retrieving Marketplace product versions for {product_key}: page {page}')
-        r = requests.get(mac_url + request_url, params=params)
+        with events.span('discovery.marketplace', page=page) as event:
+            r = http_get(MAC_URL + request_url, event, params=params)
         version_data = r.json()
         for version in version_data['_embedded']['versions']:
             if release_filter(version['name']):
@@ -114,8 +304,9 @@ pac_url_map = {
 }
 
 def fetch_all_pac_versions(product_key):
-    meta_url = f'https://packages.atlassian.com/maven-external/com/atlassian/{pac_url_map[product_key]}/maven-metadata.xml'
-    r = requests.get(meta_url)
+    meta_url = f'{PAC_URL}/{pac_url_map[product_key]}/maven-metadata.xml'
+    with events.span('discovery.pac') as event:
+        r = http_get(meta_url, event)
     xml = xmltree.fromstring(r.text)
 
     versions = list(map(lambda ve: ve.text, xml.findall('.//version')))
@@ -167,7 +358,8 @@ def fetch_mac_eap_versions(product_key):
     elif product_key == 'bitbucket':
         feed_key = 'stash'
     logging.info(f'Retrieving EAP versions for {product_key}')
-    r = requests.get(f'https://my.atlassian.com/download/feeds/eap/{feed_key}.json')
+    with events.span('discovery.eap') as event:
+        r = http_get(f'{EAP_FEED_URL}/{feed_key}.json', event)
     data = json.loads(r.text[10:-1])
     versions = set()
     for item in data:
@@ -213,6 +405,33 @@ def latest_eap(version, eap_versions):
     return version in eap_versions[-1:]
 
 
+# Lower sorts first: versions carrying 'latest' (or 'eap'), then major
+# heads, then minor heads, then everything else.
+def tag_priority(version, tags, tag_suffixes=()):
+    aliases = set()
+    for tag in tags:
+        if tag in tag_suffixes:
+            aliases.add('latest')
+        for suffix in tag_suffixes:
+            if tag.endswith(f'-{suffix}'):
+                tag = tag[:-len(suffix) - 1]
+        aliases.add(tag)
+    if aliases & {'latest', 'eap'}:
+        return 0
+    if version.split('.')[0] in aliases:
+        return 1
+    if '.'.join(version.split('.')[:2]) in aliases:
+        return 2
+    return 3
+
+
+# Most important first (see tag_priority), newest first within each level.
+def build_order(versions, priority):
+    versions = sorted(versions, key=Version, reverse=True)
+    versions.sort(key=priority)
+    return versions
+
+
 def str2bool(v):
     if str(v).lower() in ('yes', 'true', 't', 'y', '1'):
         return True
@@ -223,6 +442,50 @@ def parse_buildargs(buildargs):
     return dict(item.split("=") for item in buildargs.split(","))
 
 
+dockerfile_arg_pattern = re.compile(r'^ARG\s+([A-Za-z_][A-Za-z0-9_]*)(?:=(.*))?$', re.IGNORECASE)
+dockerfile_from_pattern = re.compile(r'^FROM\s+(?:--\S+\s+)*(\S+)(?:\s+AS\s+(\S+))?', re.IGNORECASE)
+dockerfile_var_pattern = re.compile(r'\$(?:\{([A-Za-z_][A-Za-z0-9_]*)(?::([-+])([^}]*))?\}|([A-Za-z_][A-Za-z0-9_]*))')
+
+
+def expand_dockerfile_vars(value, variables):
+    def substitute(match):
+        name = match.group(1) or match.group(4)
+        current = variables.get(name, '')
+        if match.group(2) == '-':
+            return current or match.group(3)
+        if match.group(2) == '+':
+            return match.group(3) if current else ''
+        return current
+    return dockerfile_var_pattern.sub(substitute, value)
+
+
+# The external images a Dockerfile builds FROM, given the build args. As in
+# Docker, only ARGs declared before the first FROM can be used in FROM lines,
+# and build args only override ARGs that are declared.
+def base_images(dockerfile, buildargs):
+    lines = re.sub(r'\\\n', ' ', dockerfile).splitlines()
+    global_args = {}
+    stages = set()
+    images = []
+    seen_from = False
+    for line in (l.strip() for l in lines):
+        arg = dockerfile_arg_pattern.match(line)
+        if arg and not seen_from:
+            # Defaults may refer to the ARGs declared before them.
+            default = expand_dockerfile_vars((arg.group(2) or '').strip().strip('"\''), global_args)
+            global_args[arg.group(1)] = buildargs.get(arg.group(1), default)
+            continue
+        stage = dockerfile_from_pattern.match(line)
+        if stage:
+            seen_from = True
+            image = expand_dockerfile_vars(stage.group(1), global_args)
+            if image.lower() != 'scratch' and image not in stages and image not in images:
+                images.append(image)
+            if stage.group(2):
+                stages.add(stage.group(2))
+    return images
+
+
 # This method will split a list of product versions across a batch count.
 # For the given batch the corresponding list of product versions is
 # returned.
@@ -238,7 +501,74 @@ def batch_job(product_versions, batch_count, batch):
     return product_versions[start:end]
 
 
-def run_script(script, *args):
+# Docker reports per-layer progress while pushing; the last 'total' seen for
+# each layer is the number of bytes sent for it.
+def pushed_bytes(progress):
+    layers = {}
+    for line in progress:
+        detail = line.get('progressDetail') or {}
+        if 'id' in line and 'total' in detail:
+            layers[line['id']] = detail['total']
+    return sum(layers.values())
+
+
+# Summarise a (legacy builder) build log: how many Dockerfile steps ran and
+# how many of them were satisfied from the layer cache.
+def build_cache_stats(build_log):
+    stats = {'steps': 0, 'cache_hits': 0}
+    for line in build_log:
+        stream = line.get('stream', '')
+        if stream.startswith('Step '):
+            stats['steps'] += 1
+        elif 'Using cache' in stream:
+            stats['cache_hits'] += 1
+    return stats
+
+
+# Lines of a hook's output kept in memory, to log when it fails.
+HOOK_TAIL_LINES = 50
+# Longer lines are split, so that a hook can't grow the buffer unbounded.
+HOOK_LINE_LIMIT = 64 * 1024
+# Time allowed between SIGTERM and SIGKILL for a timed-out hook.
+HOOK_KILL_GRACE = 10
+# Time allowed for the output to be drained once a hook has exited.
+HOOK_DRAIN_TIMEOUT = 1
+
+
+# The reader owns the log file and closes it once the output ends, so that
+# it is never closed under a reader that is still running.
+def _stream_output(pipe, out, tail, close_out=False):
+    try:
+        for line in iter(lambda: pipe.readline(HOOK_LINE_LIMIT), b''):
+            text = line.decode(errors='replace')
+            out.write(text)
+            out.flush()
+            tail.append(text.rstrip('\n'))
+    finally:
+        pipe.close()
+        if close_out:
+            out.close()
+
+
+# The hook leads its own session, so this also reaches anything it started
+# (test runners, scanners, docker clients), including processes that
+# outlive the hook itself.
+def _kill_group(proc, grace=HOOK_KILL_GRACE):
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    try:
+        proc.wait(timeout=grace)
+    except subprocess.TimeoutExpired:
+        pass
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def run_script(script, *args, env=None, timeout=None, log_path=None):
     if not os.path.exists(script):
         msg = f"Script '{script}' does not exist; failing!"
         logging.error (msg)
@@ -247,11 +577,127 @@ def run_script(script, *args):
     # run provided test script - terminate with error if the test failed
     script_command = [script] + list(args)
     logging.info(f'Running script: "{script_command}"')
-    proc = subprocess.run(script_command)
-    if proc.returncode != 0:
+    out = open(log_path, 'a') if log_path is not None else sys.stdout
+    if log_path is not None:
+        logging.info(f'Writing the output of {script} to {log_path}')
+        out.write(f'==> {script_command}\n')
+        out.flush()
+    tail = collections.deque(maxlen=HOOK_TAIL_LINES)
+    try:
+        proc = subprocess.Popen(script_command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                stdin=subprocess.DEVNULL, start_new_session=True)
+    except OSError:
+        if log_path is not None:
+            out.close()
+        raise
+    reader = threading.Thread(target=_stream_output, args=(proc.stdout, out, tail, log_path is not None),
+                              daemon=True)
+    reader.start()
+    try:
+        try:
+            proc.wait(timeout=timeout)
+            timed_out = False
+        except subprocess.TimeoutExpired:
+            _kill_group(proc)
+            timed_out = True
+        reader.join(HOOK_DRAIN_TIMEOUT)
+        if reader.is_alive():
+            # Processes the hook left running in the background hold the output
+            # open; they must not outlive it.
+            logging.warning(f'Script {script} left processes running; killing them')
+            _kill_group(proc, grace=0)
+            reader.join(HOOK_KILL_GRACE)
+    except BaseException:
+        # The hook is in its own session, out of reach of e.g. a Ctrl-C in
+        # the terminal, so take it down with us.
+        _kill_group(proc, grace=0)
+        proc.wait()
+        raise
+
+    if timed_out:
+        msg = f"Script '{script}' timed out after {timeout}s; failing!"
+    elif proc.returncode != 0:
         msg = f"Script '{script}' exited with non-zero ({proc.returncode}); failing!"
-        logging.error(msg)
-        raise TestFailedException(msg)
+    else:
+        return
+    if log_path is not None and tail:
+        lines = list(tail)
+        logging.error(f'Last {len(lines)} lines of output from {script}:\n' + '\n'.join(lines))
+    logging.error(msg)
+    if timed_out:
+        raise HookTimeoutException(msg)
+    raise TestFailedException(msg)
+
+
+DEFAULT_GC_HIGH_WATER = 20 * 1024**3
+# 'docker system df' walks every image, container and volume, which is slow
+# on a busy daemon, so the image storage is checked at most this often.
+GC_CHECK_INTERVAL = 60
+
+
+# Removes the images of finished releases, and prunes dangling layers once
+# the daemon's image storage crosses the high-water mark. A build's
+# intermediate layers are dangling until it completes, so pruning waits for
+# in-flight builds to finish and holds back new ones meanwhile.
+class ImageCollector:
+
+    def __init__(self, docker_cli, high_water=DEFAULT_GC_HIGH_WATER, check_interval=GC_CHECK_INTERVAL):
+        self.docker_cli = docker_cli
+        self.high_water = high_water
+        self.check_interval = check_interval
+        self._checked = None
+        self._cond = threading.Condition()
+        self._building = 0
+        self._pruning = False
+
+    @contextlib.contextmanager
+    def building(self):
+        with self._cond:
+            self._cond.wait_for(lambda: not self._pruning)
+            self._building += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._building -= 1
+                self._cond.notify_all()
+
+    def remove(self, references):
+        with events.span('gc.remove'):
+            for reference in references:
+                try:
+                    # Leave the parent layers for the build cache and prune().
+                    self.docker_cli.images.remove(reference, noprune=True)
+                except docker.errors.NotFound:
+                    pass
+                except docker.errors.APIError as exc:
+                    logging.warning(f'Removing image "{reference}" failed: {exc}')
+
+    def layers_size(self):
+        return self.docker_cli.df().get('LayersSize') or 0
+
+    def collect(self):
+        with self._cond:
+            now = time.monotonic()
+            if self._pruning or (self._checked is not None and now - self._checked < self.check_interval):
+                return
+            self._checked = now
+        if self.layers_size() < self.high_water:
+            return
+        with self._cond:
+            if self._pruning:
+                return
+            self._pruning = True
+            try:
+                self._cond.wait_for(lambda: self._building == 0)
+                logging.info('Image storage is above the high-water mark; pruning dangling images')
+                with events.span('gc.prune') as event:
+                    result = self.docker_cli.images.prune(filters={'dangling': True})
+                    event['bytes'] = (result or {}).get('SpaceReclaimed') or 0
+                logging.info(f'Pruning reclaimed {event["bytes"]} bytes')
+            finally:
+                self._pruning = False
+                self._cond.notify_all()
 
 
 class ReleaseManager:
@@ -259,44 +705,179 @@ class ReleaseManager:
     def __init__(self, start_version, end_version, concurrent_builds, default_release,
                  docker_repos, dockerfile, dockerfile_buildargs, dockerfile_version_arg,
                  product_key, tag_suffixes, push_docker, post_build_hook, post_push_hook,
-                 job_offset=None, jobs_total=None):
+                 job_offset=None, jobs_total=None, plan=None, manifest_probe_limit=DEFAULT_PROBE_LIMIT,
+                 gc_images=False, gc_high_water=DEFAULT_GC_HIGH_WATER, docker_hosts=None,
+                 journal=None, resume=False, keep_going=False, hook_timeouts=None, hook_log_dir=None):
         self.start_version = Version(start_version)
         if end_version is not None:
             self.end_version = Version(end_version)
         else:
             self.end_version = Version(self.start_version.major + 1)
-        self.concurrent_builds = int(concurrent_builds or 1)
         self.default_release = default_release
-        self.docker_cli = docker.from_env()
+
+        # Each daemon's connection pool needs to cover the concurrent
+        # builds and pushes that may be assigned to it.
+        if concurrent_builds == 'auto':
+            pool_size = max(docker.constants.DEFAULT_MAX_POOL_SIZE, os.cpu_count() or 1)
+        else:
+            pool_size = max(docker.constants.DEFAULT_MAX_POOL_SIZE, int(concurrent_builds or 1))
+        self.daemons = DaemonPool.from_hosts(docker_hosts, pool_size)
+
+        # Per-stage limits within the worker pool; only used with 'auto'.
+        self.limiters = {}
+        if concurrent_builds == 'auto':
+            limits = auto_limits(self.daemons.info(), memory=available_memory())
+            logging.info(f'Automatic concurrency limits: {limits}')
+            # Post-build hooks (func tests, scans) take far longer than
+            # post-push ones, so each has its own limiter.
+            limits['hook.post_build'] = limits['hook.post_push'] = limits.pop('hook')
+            self.limiters = {stage: AdaptiveLimiter(stage, limit) for stage, limit in limits.items()}
+            # Enough workers for builds to carry on while others hook and push.
+            self.concurrent_builds = self.limiters['build'].maximum * 2
+        else:
+            self.concurrent_builds = int(concurrent_builds or 1)
 
         self.tag_suffixes = set(tag_suffixes or set())
-        self.target_repos = get_targets(docker_repos)
 
+        self.product_key = product_key
+        self.docker_repos = docker_repos
         self.dockerfile = dockerfile
         self.dockerfile_buildargs = dockerfile_buildargs
         self.dockerfile_version_arg = dockerfile_version_arg
         self.push_docker = push_docker
         self.post_push_hook = post_push_hook
         self.post_build_hook = post_build_hook
+        # Seconds, by hook ('post_build', 'post_push').
+        self.hook_timeouts = hook_timeouts or {}
+        self.hook_log_dir = hook_log_dir
         self.job_offset = job_offset
         self.jobs_total = jobs_total
+        self.manifest_probe_limit = manifest_probe_limit or 0
+        self.profiler = None
+        self.variant_name = None
+        self.image_collectors = {}
+        if gc_images:
+            self.image_collectors = {daemon.name: ImageCollector(daemon.client, gc_high_water)
+                                     for daemon in self.daemons.daemons}
+        self.planned_builds = {}
+        self.release_tags = {}
+        self.journal = Journal(journal, resume) if journal is not None else None
+        self._context_digest = None
+        # (version, inputs digest, image id) of the release being worked on
+        # by the current thread, for the journal.
+        self._current = threading.local()
+        self.keep_going = keep_going
+        self.failures = []
+        self._failures_lock = threading.Lock()
+        self.max_retries = 5
+
+        # When executing a plan all discovery was done up front by the
+        # planning run; just take this shard's builds from it.
+        if plan is not None:
+            self.target_repos = [TargetRepo(repo, set()) for repo in docker_repos]
+            self.avail_versions = plan['avail_versions']
+            self.eap_release_versions = plan['eap_release_versions']
+            self.release_versions = []
+            for build in plan['builds']:
+                if job_offset is None or build['shard'] == job_offset:
+                    self.planned_builds[build['version']] = PlannedBuild(**build)
+            logging.info(f'Will process planned versions: {list(self.planned_builds)}')
+            return
 
-        self.avail_versions = fetch_release_versions(product_key)
-        self.release_versions = [v for v in self.avail_versions
-                                 if self.start_version <= Version(v) < self.end_version]
-        self.eap_release_versions = [v for v in fetch_eap_versions(product_key)
-                                     if self.start_version.major <= Version(v).major]
+        self.discover()
 
-        self.max_retries = 5
+    def discover(self):
+        with events.span('discovery'):
+            self.target_repos = get_targets(self.docker_repos)
+            self.avail_versions = fetch_release_versions(self.product_key)
+            self.release_versions = [v for v in self.avail_versions
+                                     if self.start_version <= Version(v) < self.end_version]
+            self.eap_release_versions = [v for v in fetch_eap_versions(self.product_key)
+                                         if self.start_version.major <= Version(v).major]
+        # Tags depend on the other available versions.
+        self.release_tags = {}
 
         # If we're running batched just take 'our share'.
-        if job_offset is not None and jobs_total is not None:
-            self.release_versions = batch_job(self.release_versions, jobs_total, job_offset)
-            self.eap_release_versions = batch_job(self.eap_release_versions, jobs_total, job_offset)
+        if self.job_offset is not None and self.jobs_total is not None:
+            self.release_versions = batch_job(self.release_versions, self.jobs_total, self.job_offset)
+            self.eap_release_versions = batch_job(self.eap_release_versions, self.jobs_total, self.job_offset)
 
         logging.info(f'Will process release versions: {self.release_versions}')
         logging.info(f'Will process EAP versions: {self.eap_release_versions}')
 
+    # Keep polling for new versions and build them as they appear. Versions
+    # are only checked against the registry the first time they're seen (or
+    # again after their build failed).
+    def watch(self, interval, create=True, create_eap=False, iterations=None):
+        enable_http_cache()
+        seen = set()
+        iteration = 0
+        while True:
+            iteration += 1
+            try:
+                if iteration > 1:
+                    self.discover()
+                if create:
+                    self._build_new(self.release_versions, seen)
+                if create_eap:
+                    self._build_new(self.eap_release_versions, seen, is_prerelease=True)
+            except Exception as exc:
+                logging.error(f'Watch iteration {iteration} failed; retrying next time: {exc}')
+            logging.info(f'Iteration summary:\n{events.summary()}')
+            events.reset()
+            if iterations is not None and iteration >= iterations:
+                return
+            logging.info(f'Waiting {interval}s for new versions')
+            time.sleep(interval)
+
+    def _build_new(self, versions, seen, is_prerelease=False):
+        new = [v for v in versions if v not in seen]
+        if not new:
+            logging.info('No new versions')
+            return
+        unbuilt = self.unbuilt_versions(new)
+        seen.update(v for v in new if v not in unbuilt)
+        if unbuilt:
+            self.failures = []
+            self.build_releases(unbuilt, is_prerelease=is_prerelease)
+            failed = {f['version'] for f in self.failures}
+            seen.update(v for v in unbuilt if v not in failed)
+
+    # The client for the daemon the current thread's release is assigned to.
+    @property
+    def docker_cli(self):
+        return self.daemons.current().client
+
+    @property
+    def image_collector(self):
+        return self.image_collectors.get(self.daemons.current().name)
+
+    # Hooks run docker commands against the daemon that built the image.
+    def _hook_env(self):
+        daemon_env = self.daemons.current().env
+        if not daemon_env:
+            return None
+        return {**os.environ, **daemon_env}
+
+    # One log file per version (and variant), appended to by each of its hooks.
+    def _hook_log(self, event):
+        if self.hook_log_dir is None:
+            return None
+        name = event.get('version') or event.get('tag')
+        if self.variant_name:
+            name = f'{name}-{self.variant_name}'
+        os.makedirs(self.hook_log_dir, exist_ok=True)
+        return os.path.join(self.hook_log_dir, re.sub(r'[^\w.-]+', '_', name) + '.log')
+
+    def _run_hook(self, stage, script, *args, **fields):
+        timeout = self.hook_timeouts.get(stage.partition('.')[2])
+        with self._slot(stage), events.span(stage, **fields) as event:
+            try:
+                run_script(script, *args, env=self._hook_env(), timeout=timeout, log_path=self._hook_log(event))
+            except HookTimeoutException:
+                event['timed_out'] = True
+                raise
+
     def create_releases(self):
         logging.info('##### Creating new releases #####')
         logging.info(f"Versions: {self.release_versions}")
@@ -314,6 +895,191 @@ class ReleaseManager:
         versions_to_build = self.unbuilt_versions(self.eap_release_versions)
         return self.build_releases(versions_to_build, is_prerelease=True)
 
+    def sync_aliases(self):
+        logging.info('##### Syncing alias tags #####')
+        # Listings taken before this run's --create/--update pushes are stale.
+        for target in self.target_repos:
+            target.existing_tags = None
+        unbuilt = set(self.unbuilt_versions(self.release_versions))
+        built = [v for v in self.release_versions if v not in unbuilt]
+        for repo, alias, source in self.alias_moves(built):
+            self._retag(repo, source, alias)
+        # New versions are built as usual, which pushes their aliases too.
+        if unbuilt:
+            self.build_releases(list(unbuilt))
+
+    # The tag each of a version's alias tags ('latest', major, major.minor,
+    # bare suffixes...) should point at: its own full version tag, with the
+    # same suffix.
+    def alias_sources(self, version, tags):
+        sources = {}
+        for tag in tags:
+            if tag in self.tag_suffixes:
+                sources[tag] = f'{version}-{tag}'
+                continue
+            source = version
+            for suffix in self.tag_suffixes:
+                if tag.endswith(f'-{suffix}'):
+                    source = f'{version}-{suffix}'
+            if tag != source:
+                sources[tag] = source
+        return sources
+
+    # The (repo, alias, source) retags needed for the registry to match
+    # calculate_tags() for the given already-published versions.
+    def alias_moves(self, versions):
+        pairs = []
+        for version in versions:
+            if version not in self.release_tags:
+                self.release_tags[version] = self._tags(version)
+            for alias, source in sorted(self.alias_sources(version, self.release_tags[version]).items()):
+                for target in self.target_repos:
+                    pairs.append((target.repo, alias, source))
+        tags = sorted({(repo, tag) for repo, alias, source in pairs for tag in (alias, source)})
+        if not tags:
+            return []
+        logging.info(f'Checking the digests of {len(tags)} alias and source tags')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=PROBE_CONCURRENCY) as executor:
+            digests = dict(zip(tags, executor.map(lambda t: manifest_digest(*t), tags)))
+        moves = [(repo, alias, source) for repo, alias, source in pairs
+                 if digests[(repo, source)] is not None and digests[(repo, alias)] != digests[(repo, source)]]
+        logging.info(f'Found {len(moves)} alias tags to move')
+        return moves
+
+    def _retag(self, repo, source, alias):
+        release = f'docker-public.packages.atlassian.com/{repo}:{alias}'
+        if not self.push_docker:
+            logging.info(f'Skipping move of tag "{release}" to {source}')
+            return
+        logging.info(f'Moving tag "{release}" to {source}')
+        with events.span('retag', repo=repo, tag=alias):
+            retag(repo, source, alias)
+        self._run_post_push_hook(release)
+
+    def plan_releases(self, create=False, update=False, create_eap=False):
+        logging.info('##### Planning releases #####')
+        # Shards are assigned after filtering out already-published versions
+        # so that each shard gets an even share of the actual builds.
+        planned = {}
+        if create:
+            for version in sorted(self.unbuilt_versions(self.release_versions), key=Version, reverse=True):
+                planned.setdefault(version, False)
+        if update:
+            for version in self.release_versions:
+                planned.setdefault(version, False)
+        if create_eap:
+            for version in sorted(self.unbuilt_versions(self.eap_release_versions), key=Version, reverse=True):
+                planned.setdefault(version, True)
+
+        versions = list(planned)
+        jobs_total = self.jobs_total or 1
+        shards = {}
+        for shard in range(jobs_total):
+            for version in batch_job(versions, jobs_total, shard):
+                shards[version] = shard
+
+        builds = []
+        for version in versions:
+            build = PlannedBuild(version=version,
+                                 tags=sorted(self.calculate_tags(version)),
+                                 test_candidate=latest_minor(version, self.avail_versions),
+                                 is_prerelease=planned[version],
+                                 shard=shards[version])
+            logging.info(f'Shard {build.shard}: {version} '
+                         f'(test candidate: {str(build.test_candidate).lower()}) tags: {", ".join(build.tags)}')
+            builds.append(dataclasses.asdict(build))
+
+        return {
+            'format': PLAN_FORMAT,
+            'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'config': {
+                'start_version': self.start_version.v_raw,
+                'end_version': self.end_version.v_raw or None,
+                'default_release': self.default_release,
+                'docker_repos': self.docker_repos,
+                'dockerfile': self.dockerfile,
+                'dockerfile_buildargs': self.dockerfile_buildargs,
+                'dockerfile_version_arg': self.dockerfile_version_arg,
+                'product_key': self.product_key,
+                'tag_suffixes': sorted(self.tag_suffixes),
+            },
+            'jobs_total': jobs_total,
+            'avail_versions': self.avail_versions,
+            'eap_release_versions': self.eap_release_versions,
+            'builds': builds,
+        }
+
+    # A manager for one variant of the image. It shares this manager's
+    # discovery results, registry tag cache, daemons, concurrency limits,
+    # journal and failure list.
+    def variant(self, **settings):
+        variant = copy.copy(self)
+        for key, value in settings.items():
+            if key == 'tag_suffixes':
+                value = set(value.split(',') if isinstance(value, str) else value or [])
+            setattr(variant, key, value)
+        variant.variant_name = ' '.join(filter(None, [variant.dockerfile or 'Dockerfile',
+                                                      ','.join(sorted(variant.tag_suffixes))]))
+        variant.release_tags = {}
+        variant._context_digest = None
+        return variant
+
+    # Build several variants of the image in one go. Work is scheduled by
+    # version across all the variants under the one concurrency budget; the
+    # variants of a version are built one after another, so that each build
+    # can reuse the layers the previous ones share with it from the cache.
+    def release_variants(self, variants, create=False, update=False, create_eap=False):
+        logging.info(f'##### Releasing {len(variants)} variants #####')
+        managers = [self.variant(**settings) for settings in variants]
+        work = {}
+        for manager in managers:
+            builds = []
+            if create:
+                builds += [(v, False) for v in manager.unbuilt_versions(manager.release_versions)]
+            if update:
+                builds += [(v, False) for v in manager.release_versions]
+            if create_eap:
+                builds += [(v, True) for v in manager.unbuilt_versions(manager.eap_release_versions)]
+            for version, is_prerelease in builds:
+                if (manager, is_prerelease) not in work.setdefault(version, []):
+                    work[version].append((manager, is_prerelease))
+            logging.info(f'{manager.variant_name}: {len(builds)} builds')
+        if not work:
+            logging.info('Nothing to build')
+            return
+
+        # A version is as important as its most important variant's tags.
+        versions = build_order(work, lambda v: min(m._priority(v) for m, _ in work[v]))
+        logging.info(f'Building {sum(len(w) for w in work.values())} images for {len(versions)} versions: {versions}')
+
+        # All of a version's variants go to the same daemon, whose build
+        # cache then holds the layers they share.
+        def release(version):
+            with self.daemons.use() as daemon:
+                for manager, is_prerelease in work[version]:
+                    manager._build_release(version, is_prerelease, daemon)
+
+        if self.concurrent_builds > 1:
+            # Variants mostly share their base images; pull each one once.
+            images = []
+            for manager in managers:
+                for image in manager._base_images([v for v in versions if any(m is manager for m, _ in work[v])]):
+                    if image not in images:
+                        images.append(image)
+            self._pull_images(images)
+            self._run_concurrent(release, versions)
+        else:
+            for version in versions:
+                release(version)
+
+    def execute_plan(self):
+        logging.info('##### Executing planned releases #####')
+        for is_prerelease in (False, True):
+            versions_to_build = [b.version for b in self.planned_builds.values()
+                                 if b.is_prerelease == is_prerelease]
+            if versions_to_build:
+                self.build_releases(versions_to_build, is_prerelease=is_prerelease)
+
     def build_releases(self, versions_to_build, is_prerelease=False):
         logging.info(
             f'Found {len(versions_to_build)} '
@@ -322,19 +1088,80 @@ class ReleaseManager:
         logging.info(f'Building with {self.concurrent_builds} threads')
         if self.dockerfile is not None:
             logging.info(f'Using docker file "{self.dockerfile}"')
+        versions_to_build = self.prioritise(versions_to_build)
         if self.concurrent_builds > 1:
+            self._prepull_base_images(versions_to_build)
             self._build_concurrent(versions_to_build, is_prerelease)
         else:
             for version in versions_to_build:
                 self._build_release(version, is_prerelease)
 
+    # Build the versions behind the most-pulled tags first, newest first, so
+    # that a run cut short has already published the tags that matter.
+    def prioritise(self, versions):
+        versions = build_order(versions, self._priority)
+        logging.info(f'Build order: {versions}')
+        return versions
+
+    def _priority(self, version):
+        if version not in self.release_tags:
+            self.release_tags[version] = self._tags(version)
+        return tag_priority(version, self.release_tags[version], self.tag_suffixes)
+
+    def _tags(self, version):
+        if version in self.planned_builds:
+            return set(self.planned_builds[version].tags)
+        with events.context(version=version), events.span('calculate_tags'):
+            return self.calculate_tags(version)
+
+    # Concurrent builds would otherwise all pull the same FROM images at the
+    # same time; pull each distinct base image once, up front.
+    def _prepull_base_images(self, versions_to_build):
+        self._pull_images(self._base_images(versions_to_build))
+
+    def _base_images(self, versions_to_build):
+        dockerfile = os.path.join('.', self.dockerfile or 'Dockerfile')
+        if not versions_to_build or not os.path.exists(dockerfile):
+            return []
+        with open(dockerfile) as f:
+            content = f.read()
+        images = []
+        for version in versions_to_build:
+            for image in base_images(content, self._buildargs(version)):
+                if image not in images:
+                    images.append(image)
+        return images
+
+    def _pull_images(self, images):
+        if not images:
+            return
+        logging.info(f'Pre-pulling base images: {images}')
+        pulls = [(daemon, image) for daemon in self.daemons.daemons for image in images]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.concurrent_builds, len(pulls))) as executor:
+            list(executor.map(lambda pull: self._pull_image(*pull), pulls))
+
+    def _pull_image(self, daemon, image):
+        repository, tag = docker.utils.parse_repository_tag(image)
+        try:
+            with self.daemons.use(daemon), events.span('pull', tag=image):
+                self.docker_cli.images.pull(repository, tag=tag or 'latest')
+        except docker.errors.APIError as exc:
+            # Not fatal; the build will try to pull it again itself.
+            logging.warning(f'Pre-pulling "{image}" failed: {exc}')
+
     def _build_concurrent(self, versions_to_build, is_prerelease=False):
+        self._run_concurrent(lambda version: self._build_release(version, is_prerelease), versions_to_build)
+
+    def _run_concurrent(self, build_release, versions_to_build):
         executor = concurrent.futures.ThreadPoolExecutor(
             max_workers=self.concurrent_builds
         )
         builds = []
+        # When profiling, each worker thread needs its own profile.
+        if self.profiler is not None:
+            build_release = self.profiler.wrap(build_release)
         for version in versions_to_build:
-            build = executor.submit(self._build_release, version, is_prerelease)
+            build = executor.submit(build_release, version)
             builds.append(build)
         for build in concurrent.futures.as_completed(builds):
             exc = build.exception()
@@ -343,14 +1170,30 @@ class ReleaseManager:
                 executor.shutdown(wait=True, cancel_futures=True)
                 raise exc
 
+    def _slot(self, stage):
+        limiter = self.limiters.get(stage)
+        if limiter is None:
+            return contextlib.nullcontext({})
+        return limiter.slot()
+
     def _push_release(self, release, retry=0, is_prerelease=False):
         if not self.push_docker:
             logging.info(f'Skipping push of tag "{release}"')
             return
+        if self._journaled('push', release):
+            logging.info(f'Tag "{release}" was already pushed; skipping')
+            self._run_post_push_hook(release, is_prerelease)
+            return
 
+        self._current.stage = ('push', release)
         try:
             logging.info(f'Pushing tag "{release}"')
-            self.docker_cli.images.push(release)
+            repo, _, tag = release.rpartition(':')
+            with self._slot('push') as slot, events.span('push', repo=repo, tag=tag, retries=retry) as event:
+                progress = self.docker_cli.images.push(release, stream=True, decode=True)
+                event['bytes'] = pushed_bytes(progress)
+                # Tags whose layers are all in the registry already are quick.
+                slot['kind'] = 'upload' if event['bytes'] else 'exists'
         except requests.exceptions.ConnectionError as e:
             if retry > self.max_retries:
                 logging.error(f'Push failed for tag "{release}"')
@@ -361,21 +1204,35 @@ class ReleaseManager:
             self._push_release(release, retry + 1, is_prerelease)
         else:
             logging.info(f'Pushing tag "{release}" succeeded!')
+            self._record('push', release)
             self._run_post_push_hook(release, is_prerelease)
             return
 
 
-    def _build_image(self, version, retry=0):
+    def _buildargs(self, version):
         buildargs = {self.dockerfile_version_arg: version}
         if self.dockerfile_buildargs is not None:
             buildargs.update(parse_buildargs(self.dockerfile_buildargs))
+        return buildargs
+
+    def _build_image(self, version, retry=0):
+        buildargs = self._buildargs(version)
         buildargs_log_str = ', '.join(['{}={}'.format(*i) for i in buildargs.items()])
         logging.info(f'Building {version} image with buildargs: {buildargs_log_str}')
+        building = contextlib.nullcontext()
+        if self.image_collector is not None:
+            building = self.image_collector.building()
         try:
-            image = self.docker_cli.images.build(path='.',
-                                                 buildargs=buildargs,
-                                                 dockerfile=self.dockerfile,
-                                                 rm=True)[0]
+            with self._slot('build') as slot, building, \
+                    events.span('build', version=version, retries=retry) as event:
+                result = self.docker_cli.images.build(path='.',
+                                                      buildargs=buildargs,
+                                                      dockerfile=self.dockerfile,
+                                                      rm=True)
+                image = result[0]
+                event.update(build_cache_stats(result[1]))
+                # Builds are compared with others that ran as many steps.
+                slot['kind'] = event.get('steps', 0) - event.get('cache_hits', 0)
             return image
 
         except docker.errors.BuildError as exc:
@@ -391,27 +1248,127 @@ class ReleaseManager:
         time.sleep(30) # wait 30s before retrying build after failure
         return self._build_image(version, retry=retry+1)
 
-    def _build_release(self, version, is_prerelease=False):
-        logging.info(f"#### Building release {version}")
-
-        image = self._build_image(version)
-
-        # script will terminated with error if the test failed
-        logging.info(f"#### Preparing the release {version}")
-        self._run_post_build_hook(image, version)
-
-        tags =  self.calculate_tags(version)
-        logging.info('##### Pushing the image tags')
-        logging.info(f"TAGS FOR {version} ARE {tags}")
-        for tag in tags:
-            for target in self.target_repos:
-                repo = f'docker-public.packages.atlassian.com/{target.repo}'
-                release = f'{repo}:{tag}'
-
-                logging.info(f'Tagging "{release}"')
-                image.tag(repo, tag=tag)
-
-                self._push_release(release, is_prerelease)
+    def _build_release(self, version, is_prerelease=False, daemon=None):
+        # The image is built, tagged and pushed on one daemon.
+        with self.daemons.use(daemon):
+            try:
+                self._release(version, is_prerelease)
+            except Exception as exc:
+                if not self.keep_going:
+                    raise
+                self._record_failure(version, is_prerelease, exc)
+
+    def _record_failure(self, version, is_prerelease, exc):
+        stage, release = getattr(self._current, 'stage', None) or ('release', None)
+        repo, _, tag = release.rpartition(':') if release else (None, None, None)
+        failure = {
+            'version': version,
+            'variant': self.variant_name,
+            'prerelease': is_prerelease,
+            'stage': stage,
+            'repo': repo,
+            'tag': tag,
+            'error': f'{type(exc).__name__}: {exc}',
+        }
+        logging.error(f'Release {version} failed at {stage}{f" of {release}" if release else ""}: '
+                      f'{failure["error"]}; carrying on with the other versions')
+        with self._failures_lock:
+            self.failures.append(failure)
+
+    # With keep_going, fails the run once everything else has been done.
+    def check_failures(self, report_path=None):
+        if not self.failures:
+            return
+        report = {'failed': len(self.failures), 'failures': self.failures}
+        if report_path is not None:
+            with open(report_path, 'w') as f:
+                json.dump(report, f, indent=2)
+        logging.error(f'Failure report:\n{json.dumps(report, indent=2)}')
+        versions = sorted({f['version'] for f in self.failures}, key=Version)
+        raise ReleaseFailedException(f'{len(versions)} release{"" if len(versions) == 1 else "s"} failed: '
+                                     f'{", ".join(versions)}')
+
+    def _release(self, version, is_prerelease=False):
+        with events.context(version=version), events.span('release'):
+            logging.info(f"#### Building release {version}")
+
+            self._current.stage = ('build', None)
+            inputs = self._inputs(version)
+            self._current.release = (version, inputs, None)
+            image = self._journaled_image(version, inputs)
+            if image is None:
+                image = self._build_image(version)
+                self._record('build', image=image.id)
+            self._current.release = (version, inputs, image.id)
+
+            # script will terminated with error if the test failed
+            logging.info(f"#### Preparing the release {version}")
+            if self._journaled('post_build'):
+                logging.info(f'Post-build hook already passed for {version}; skipping')
+            else:
+                self._current.stage = ('post_build', None)
+                self._run_post_build_hook(image, version)
+                self._record('post_build')
+
+            tags = self.release_tags.get(version)
+            if tags is None:
+                tags = self._tags(version)
+            logging.info('##### Pushing the image tags')
+            logging.info(f"TAGS FOR {version} ARE {tags}")
+            releases = []
+            for tag in tags:
+                for target in self.target_repos:
+                    repo = f'docker-public.packages.atlassian.com/{target.repo}'
+                    release = f'{repo}:{tag}'
+
+                    logging.info(f'Tagging "{release}"')
+                    image.tag(repo, tag=tag)
+                    releases.append(release)
+
+                    self._push_release(release, is_prerelease=is_prerelease)
+
+            # Everything for this version is pushed and its hooks have run.
+            if self.image_collector is not None:
+                self._current.stage = ('gc', None)
+                logging.info(f'Removing local images for {version}')
+                self.image_collector.remove(releases + [image.id])
+                self.image_collector.collect()
+            self._current.release = None
+
+    def _inputs(self, version):
+        if self.journal is None:
+            return None
+        if self._context_digest is None:
+            self._context_digest = context_digest('.', exclude=[self.journal.path])
+        return inputs_digest(self._context_digest, self.dockerfile, self._buildargs(version))
+
+    # The image a previous run built from the same inputs, if it's still there.
+    def _journaled_image(self, version, inputs):
+        if not self._journaled('build'):
+            return None
+        image_id = self.journal.done('build', version, inputs)['image']
+        try:
+            image = self.docker_cli.images.get(image_id)
+        except docker.errors.ImageNotFound:
+            return None
+        logging.info(f'Reusing image {image_id} built for {version} by a previous run')
+        return image
+
+    def _journaled(self, step, release=None):
+        current = getattr(self._current, 'release', None)
+        if self.journal is None or current is None:
+            return False
+        version, inputs, image = current
+        repo, _, tag = release.rpartition(':') if release else (None, None, None)
+        return self.journal.done(step, version, inputs, image, repo, tag) is not None
+
+    def _record(self, step, release=None, image=None):
+        current = getattr(self._current, 'release', None)
+        if self.journal is None or current is None:
+            return
+        version, inputs, current_image = current
+        repo, _, tag = release.rpartition(':') if release else (None, None, None)
+        self.journal.record(step, version, inputs, image or current_image, repo, tag)
 
     def _run_post_build_hook(self, image, version):
         if self.post_build_hook is None or self.post_build_hook == '':
@@ -420,33 +1377,70 @@ class ReleaseManager:
 
         # Usage: post_build.sh <image-tag-or-hash> ['true' if release image]  ['true' if test candidate]
         is_release = str(self.push_docker).lower()
-        test_candidate = str(latest_minor(version, self.avail_versions)).lower()
+        if version in self.planned_builds:
+            test_candidate = str(self.planned_builds[version].test_candidate).lower()
+        else:
+            test_candidate = str(latest_minor(version, self.avail_versions)).lower()
 
-        run_script(self.post_build_hook, image.id, is_release, test_candidate)
+        self._run_hook('hook.post_build', self.post_build_hook, image.id, is_release, test_candidate)
 
     def _run_post_push_hook(self, release, is_prerelease=False):
         if self.post_push_hook is None or self.post_push_hook == '':
             logging.warning("Post-push hook is not set; skipping! ")
             return
+        if self._journaled('post_push', release):
+            logging.info(f'Post-push hook already passed for "{release}"; skipping')
+            return
 
         logging.info(f'Running hook: {self.post_push_hook}')
-        run_script(self.post_push_hook, release, str(is_prerelease).lower())
+        self._current.stage = ('post_push', release)
+        repo, _, tag = release.rpartition(':')
+        self._run_hook('hook.post_push', self.post_push_hook, release, str(is_prerelease).lower(), repo=repo, tag=tag)
+        self._record('post_push', release)
 
     def unbuilt_versions(self, candidate_versions):
-        # Only exclude tags that exist in all repos
-        existing_tags = set.intersection(*map(lambda tr: tr.existing_tags, self.target_repos))
-        if self.default_release:
-            return list(set(candidate_versions) - existing_tags)
+        with events.span('unbuilt_versions') as event:
+            versions = self._find_unbuilt_versions(candidate_versions)
+            event['candidates'] = len(candidate_versions)
+            event['skipped'] = len(candidate_versions) - len(versions)
+        return versions
 
-        versions = set()
-        for v in candidate_versions:
-            for suffix in self.tag_suffixes:
-                tag = f'{v}-{suffix}'
-                if tag not in existing_tags:
-                    versions.add(v)
+    def _find_unbuilt_versions(self, candidate_versions):
+        # A version is unbuilt if any of its full version tags is missing
+        if self.default_release:
+            wanted = {v: {v} for v in candidate_versions}
+        else:
+            wanted = {v: {f'{v}-{suffix}' for suffix in self.tag_suffixes}
+                      for v in candidate_versions}
+        published = self._published_tags(set().union(*wanted.values()))
+        versions = {v for v, tags in wanted.items() if not tags <= published}
         logging.info(f"Found unbuilt: {versions}")
+        if self.default_release:
+            return list(versions)
         return versions
 
+    def _listed_tags(self, target):
+        if target.existing_tags is None:
+            target.existing_tags = existing_tags(target.repo)
+        return target.existing_tags
+
+    def _published_tags(self, candidate_tags):
+        # Only count tags that exist in all repos. Listing a repository costs
+        # the same however few tags we care about, so for a handful of
+        # candidates it is cheaper to probe each one directly.
+        probes = len(candidate_tags) * len(self.target_repos)
+        listed = all(target.existing_tags is not None for target in self.target_repos)
+        if not listed and 0 < probes <= self.manifest_probe_limit:
+            logging.info(f'Checking {len(candidate_tags)} candidate tags with manifest probes')
+            published = set(candidate_tags)
+            for target in self.target_repos:
+                published = probe_tags(target.repo, published)
+            return published
+        published = set(candidate_tags)
+        for target in self.target_repos:
+            published &= self._listed_tags(target)
+        return published
+
     def calculate_tags(self, version):
         tags = set()
         version_tags = {version}
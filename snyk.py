@@ -0,0 +1,147 @@
+import concurrent.futures
+import logging
+import re
+import sys
+import threading
+import time
+
+import requests
+
+from releasemanager import Registry, Version, existing_tags
+
+SNYK_API = 'https://snyk.io/api/v1'
+SNYK_CONCURRENCY = 8
+# Snyk allows 2000 API requests per minute per user.
+SNYK_RATE = 25
+
+DEFAULT_PROJECTS = ['bitbucket-server', 'bitbucket', 'confluence-server', 'confluence', 'crowd', 'jira-core',
+                    'jira-software', 'jira-servicemanagement', 'jira-servicedesk', 'bamboo', 'bamboo-server',
+                    'bamboo-agent-base']
+
+# Products published under more than one repository name are untagged together.
+PROJECT_FAMILIES = [
+    ('bitbucket', ['bitbucket', 'bitbucket-server']),
+    ('confluence', ['confluence', 'confluence-server']),
+    ('jira-service', ['jira-servicemanagement', 'jira-servicedesk']),
+    ('jira', ['jira-core', 'jira-software', 'jira-servicemanagement', 'jira-servicedesk']),
+]
+
+# Tags that are versions (optionally with a suffix), as opposed to e.g.
+# '7.13.0_ubuntu' which merely starts with a digit.
+VERSION_TAG = re.compile(r'^\d+(\.\d+)*(-.*)?$')
+
+
+class RateLimiter:
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def projects_for(project):
+    if project is None:
+        return list(DEFAULT_PROJECTS)
+    for key, family in PROJECT_FAMILIES:
+        if key in project:
+            return family
+    if project in ('bamboo', 'bamboo-server'):
+        return ['bamboo', 'bamboo-server']
+    if project not in DEFAULT_PROJECTS:
+        raise ValueError(f'Project must be one of: {", ".join(DEFAULT_PROJECTS)}')
+    return [project]
+
+
+def select_tags(tags, regex_tag=None, before_version=None):
+    selected = tags
+    if regex_tag is not None:
+        selected = [t for t in selected if re.search(regex_tag, t)]
+    if before_version is not None:
+        before = Version(before_version)
+        selected = [t for t in selected if VERSION_TAG.match(t) and Version(t) < before]
+    return sorted(selected)
+
+
+def snyk_project_names(projects, regex_tag=None, before_version=None):
+    names = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(projects) or 1) as executor:
+        listings = executor.map(lambda p: existing_tags(f'atlassian/{p}'), projects)
+        for project, tags in zip(projects, listings):
+            for tag in select_tags(tags, regex_tag, before_version):
+                names.append(f'{Registry.DOCKER_REGISTRY}/atlassian/{project}:{tag}')
+    return names
+
+
+class SnykClient:
+
+    def __init__(self, token, org_id, api=SNYK_API, rate=SNYK_RATE, concurrency=SNYK_CONCURRENCY):
+        self.org_id = org_id
+        self.api = api.rstrip('/')
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate)
+        self.session = requests.Session()
+        self.session.mount(self.api, requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+        self.session.headers.update({'Authorization': f'token {token}', 'Content-Type': 'application/json'})
+
+    def _post(self, path, body):
+        self.limiter.wait()
+        r = self.session.post(f'{self.api}{path}', json=body)
+        r.raise_for_status()
+        return r
+
+    # One listing for the whole org, rather than a filtered lookup per project.
+    def project_ids(self):
+        projects = self._post(f'/org/{self.org_id}/projects', {}).json()['projects']
+        return {p['name']: p['id'] for p in projects}
+
+    def remove_tag(self, project_id, key, value):
+        self._post(f'/org/{self.org_id}/project/{project_id}/tags/remove', {'key': key, 'value': value})
+
+    def untag(self, names, key, value):
+        ids = self.project_ids()
+        monitored = [(name, ids[name]) for name in names if name in ids]
+        for name in names:
+            if name not in ids:
+                logging.info(f'Skipped {name} - not monitored by Snyk')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {executor.submit(self.remove_tag, project_id, key, value): name
+                       for name, project_id in monitored}
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+                logging.info(f'Un-tagged {futures[future]}')
+        return [name for name, _ in monitored]
+
+
+def confirm(prompt):
+    if not sys.stdin.isatty():
+        logging.error('Not running interactively; pass --yes to confirm')
+        return False
+    while True:
+        answer = input(f'{prompt} (y/n): ').strip().lower()
+        if answer.startswith('y'):
+            return True
+        if answer.startswith('n'):
+            return False
+        print('Please answer yes or no.')
+
+
+def untag(args):
+    projects = projects_for(args.project)
+    logging.info(f'Gathering Snyk projects for {", ".join(projects)}')
+    names = snyk_project_names(projects, args.regex_tag, args.before_version)
+    if not names:
+        logging.info('No matching projects found')
+        return []
+    print('\n'.join(names))
+    if not args.yes and not confirm('Please review the project list and confirm to un-tag them'):
+        return []
+    client = SnykClient(args.token, args.org_id, args.snyk_api, args.rate, args.concurrency)
+    return client.untag(names, args.tag_key, args.tag_value)
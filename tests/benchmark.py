@@ -0,0 +1,127 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from unittest import mock
+
+from releasemanager import DEFAULT_PROBE_LIMIT, ReleaseManager, Version, batch_job, fetch_eap_versions, fetch_release_versions, existing_tags
+from tests.mockserver import MockServer, synthetic_eap_versions, synthetic_tags, synthetic_versions
+
+# Offline performance benchmarks for discovery and planning. Everything is
+# served by a local mock Marketplace/EAP feed/Maven/registry, so the numbers
+# measure this code rather than the network:
+#
+#   python -m tests.benchmark --scales 10,100,1000 --output bench.json --baseline bench-baseline.json
+
+PRODUCT_KEY = 'jira-software'
+REPO = 'atlassian/jira-software'
+SUFFIXES = ['jdk11', 'ubuntu']
+
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def manager_config(scale):
+    return {
+        'start_version': '1',
+        'end_version': str(scale // 100 + 2),
+        'concurrent_builds': 1,
+        'default_release': True,
+        'docker_repos': [REPO],
+        'dockerfile': None,
+        'dockerfile_buildargs': None,
+        'dockerfile_version_arg': 'JIRA_VERSION',
+        'product_key': PRODUCT_KEY,
+        'tag_suffixes': SUFFIXES,
+        'push_docker': False,
+        'post_build_hook': None,
+        'post_push_hook': None,
+    }
+
+
+def bench_scale(scale, repeat):
+    versions = synthetic_versions(scale)
+    eap_versions = synthetic_eap_versions(max(1, scale // 10))
+    # Everything but the newest 5% is already published.
+    tags = synthetic_tags(versions, scale * (len(SUFFIXES) + 1), SUFFIXES, unbuilt=max(1, scale // 20))
+    results = {}
+    with MockServer(versions, eap_versions, {REPO: tags}), mock.patch('releasemanager.docker.from_env'):
+        results['discovery.releases'] = timed(lambda: fetch_release_versions(PRODUCT_KEY), repeat)
+        results['discovery.eap'] = timed(lambda: fetch_eap_versions(PRODUCT_KEY), repeat)
+        results['discovery.tags'] = timed(lambda: existing_tags(REPO), repeat)
+        results['discovery.total'] = timed(lambda: ReleaseManager(**manager_config(scale)), repeat)
+
+        manager = ReleaseManager(**manager_config(scale))
+
+        # Both lookup strategies, starting without any cached tag listing.
+        def unbuilt(versions, probe_limit):
+            manager.manifest_probe_limit = probe_limit
+            for target in manager.target_repos:
+                target.existing_tags = None
+            return manager.unbuilt_versions(versions)
+        newest = sorted(manager.release_versions, key=Version, reverse=True)[:20]
+        results['unbuilt_versions.list'] = timed(lambda: unbuilt(manager.release_versions, 0), repeat)
+        results['unbuilt_versions.probe20'] = timed(lambda: unbuilt(newest, DEFAULT_PROBE_LIMIT), repeat)
+        # Each call scans the whole history, so time a fixed sample of 100
+        # calls to keep the largest scales practical.
+        sample = manager.release_versions[::max(1, len(manager.release_versions) // 100)][:100]
+        results['calculate_tags_x100'] = timed(lambda: [manager.calculate_tags(v) for v in sample], repeat)
+        results['batch_planning'] = timed(
+            lambda: [batch_job(manager.release_versions, 12, offset) for offset in range(12)], repeat)
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for scale, benches in results.items():
+        for name, seconds in benches.items():
+            previous = baseline.get(scale, {}).get(name)
+            if previous and seconds > previous * threshold:
+                regressions.append((scale, name, previous, seconds))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark release-maker discovery and planning offline')
+    parser.add_argument('--scales', default='10,100,1000,10000',
+                        help='Comma-separated numbers of versions (and tags per version suffix) to benchmark.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per benchmark; the fastest is recorded.')
+    parser.add_argument('--output', default=None, help='Write the results to this JSON file.')
+    parser.add_argument('--baseline', default=None, help='Compare against results previously written with --output.')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='Slowdown factor against the baseline that counts as a regression.')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    results = {}
+    for scale in [int(s) for s in args.scales.split(',')]:
+        results[str(scale)] = bench_scale(scale, args.repeat)
+        for name, seconds in results[str(scale)].items():
+            print(f'{scale:>6} {name:<24} {seconds * 1000:>12.2f}ms')
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline is not None and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for scale, name, previous, seconds in regressions:
+            print(f'REGRESSION {scale} {name}: {previous * 1000:.2f}ms -> {seconds * 1000:.2f}ms')
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
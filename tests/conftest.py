@@ -19,5 +19,6 @@ def refapp():
         'post_push_hook': None,
         'job_offset': None,
         'jobs_total': None,
+        'manifest_probe_limit': 0,
     }
     return app
@@ -0,0 +1,207 @@
+import contextlib
+import hashlib
+import http.server
+import json
+import threading
+import urllib.parse
+from unittest import mock
+
+import releasemanager
+
+
+# Version i of a synthetic product history: 1.0.0, 1.0.1 ... 1.9.9, 2.0.0 ...
+def synthetic_versions(count):
+    return [f'{i // 100 + 1}.{i // 10 % 10}.{i % 10}' for i in range(count)]
+
+
+def synthetic_eap_versions(count):
+    return [f'{i // 10 + 1}.0.0-RC{i % 10 + 1}' for i in range(count)]
+
+
+# The registry tags for a history: every version plus its suffixed tags, up
+# to `count` tags in total, leaving the newest `unbuilt` versions out.
+def synthetic_tags(versions, count, suffixes=('jdk11', 'ubuntu'), unbuilt=0):
+    published = versions[:len(versions) - unbuilt]
+    candidates = [tag for v in published for tag in [v] + [f'{v}-{s}' for s in suffixes]]
+    return candidates[:count]
+
+
+class MockServer:
+
+    def __init__(self, versions=(), eap_versions=(), tags=None, page_size=50, tags_page_size=100, snyk_projects=None):
+        self.versions = list(versions)
+        self.eap_versions = list(eap_versions)
+        self.tags = {repo: list(repo_tags) for repo, repo_tags in (tags or {}).items()}
+        self.page_size = page_size
+        self.tags_page_size = tags_page_size
+        # Snyk project name -> id
+        self.snyk_projects = dict(snyk_projects or {})
+        # (repo, tag) -> manifest, for tags pointing at another tag's image
+        self.manifests = {}
+        self.untagged = []
+        self.requests = []
+        self.not_modified = 0
+        self._server = None
+        self._patches = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}'
+
+    @property
+    def snyk_api(self):
+        return f'{self.url}/snyk'
+
+    def __enter__(self):
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self._patches = contextlib.ExitStack()
+        host = self.url.partition('://')[2]
+        for name, value in [('MAC_URL', self.url),
+                            ('EAP_FEED_URL', f'{self.url}/download/feeds/eap'),
+                            ('PAC_URL', f'{self.url}/maven-external/com/atlassian')]:
+            self._patches.enter_context(mock.patch.object(releasemanager, name, value))
+        self._patches.enter_context(mock.patch.object(releasemanager.Registry, 'SCHEME', 'http'))
+        self._patches.enter_context(mock.patch.object(releasemanager.Registry, 'DOCKER_REGISTRY', host))
+        return self
+
+    def __exit__(self, *exc):
+        self._patches.close()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def marketplace_page(self, path, query):
+        offset = int(query.get('offset', 0))
+        limit = int(query.get('limit', self.page_size))
+        page = self.versions[offset:offset + limit]
+        data = {'_embedded': {'versions': [{'name': v} for v in page]}, '_links': {}}
+        if offset + limit < len(self.versions):
+            data['_links']['next'] = {'href': f'{path}?offset={offset + limit}&limit={limit}'}
+        return 200, {}, json.dumps(data)
+
+    def eap_feed(self):
+        items = [{'description': f'EAP {v} (Jira Software)', 'zipUrl': ''} for v in self.eap_versions]
+        return 200, {}, f'downloads({json.dumps(items)})'
+
+    def maven_metadata(self):
+        versions = ''.join(f'<version>{v}</version>' for v in self.versions + self.eap_versions)
+        return 200, {}, f'<metadata><versioning><versions>{versions}</versions></versioning></metadata>'
+
+    def tags_page(self, repo, query):
+        if repo not in self.tags:
+            return 404, {}, json.dumps({'errors': [{'code': 'NAME_UNKNOWN'}]})
+        tags = sorted(self.tags[repo])
+        n = int(query.get('n', self.tags_page_size))
+        start = 0
+        if 'last' in query:
+            start = next((i + 1 for i, t in enumerate(tags) if t == query['last']), len(tags))
+        page = tags[start:start + n]
+        headers = {}
+        if start + n < len(tags):
+            headers['Link'] = f'</v2/{repo}/tags/list?n={n}&last={urllib.parse.quote(page[-1])}>; rel="next"'
+        return 200, headers, json.dumps({'name': repo, 'tags': page})
+
+    def manifest_body(self, repo, tag):
+        return self.manifests.get((repo, tag)) or json.dumps({'schemaVersion': 2, 'repo': repo, 'tag': tag})
+
+    def digest(self, repo, tag):
+        return 'sha256:' + hashlib.sha256(self.manifest_body(repo, tag).encode()).hexdigest()
+
+    # Make `tag` point at the same image as `source`.
+    def alias(self, repo, tag, source):
+        self.manifests[(repo, tag)] = self.manifest_body(repo, source)
+        if tag not in self.tags.setdefault(repo, []):
+            self.tags[repo].append(tag)
+
+    def manifest(self, repo, tag):
+        if tag not in self.tags.get(repo, ()):
+            return 404, {}, json.dumps({'errors': [{'code': 'MANIFEST_UNKNOWN'}]})
+        headers = {'Docker-Content-Digest': self.digest(repo, tag),
+                   'Content-Type': 'application/vnd.docker.distribution.manifest.v2+json'}
+        return 200, headers, self.manifest_body(repo, tag)
+
+    def put_manifest(self, repo, tag, body):
+        self.manifests[(repo, tag)] = body.decode()
+        if tag not in self.tags.setdefault(repo, []):
+            self.tags[repo].append(tag)
+        return 201, {'Docker-Content-Digest': self.digest(repo, tag)}, ''
+
+    def snyk_project_list(self):
+        projects = [{'name': name, 'id': project_id} for name, project_id in self.snyk_projects.items()]
+        return 200, {}, json.dumps({'projects': projects})
+
+    def snyk_remove_tag(self, project_id, body):
+        if project_id not in self.snyk_projects.values():
+            return 404, {}, ''
+        self.untagged.append((project_id, body['key'], body['value']))
+        return 200, {}, json.dumps({'tags': []})
+
+    def route(self, method, path, query, body=None):
+        self.requests.append((method, path))
+        if method == 'POST' and path.startswith('/snyk/org/'):
+            org_path = path[len('/snyk/org/'):].partition('/')[2]
+            if org_path == 'projects':
+                return self.snyk_project_list()
+            if org_path.startswith('project/') and org_path.endswith('/tags/remove'):
+                return self.snyk_remove_tag(org_path.split('/')[1], json.loads(body))
+        if path.startswith('/rest/2/products/key/') and path.endswith('/versions'):
+            return self.marketplace_page(path, query)
+        if path.startswith('/download/feeds/eap/'):
+            return self.eap_feed()
+        if path.startswith('/maven-external/') and path.endswith('/maven-metadata.xml'):
+            return self.maven_metadata()
+        if path.startswith('/v2/') and path.endswith('/tags/list'):
+            return self.tags_page(path[len('/v2/'):-len('/tags/list')], query)
+        if path.startswith('/v2/') and '/manifests/' in path:
+            repo, _, tag = path[len('/v2/'):].partition('/manifests/')
+            if method == 'PUT':
+                return self.put_manifest(repo, urllib.parse.unquote(tag), body)
+            return self.manifest(repo, urllib.parse.unquote(tag))
+        return 404, {}, ''
+
+    def _handler(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately; without this, keep-alive
+            # connections stall on delayed ACKs.
+            disable_nagle_algorithm = True
+
+            def respond(self, send_body):
+                url = urllib.parse.urlsplit(self.path)
+                query = dict(urllib.parse.parse_qsl(url.query))
+                length = int(self.headers.get('Content-Length') or 0)
+                request_body = self.rfile.read(length) if length else None
+                status, headers, body = server.route(self.command, url.path, query, request_body)
+                body = body.encode()
+                if self.command == 'GET' and status == 200:
+                    headers = {**headers, 'ETag': '"' + hashlib.sha256(body).hexdigest() + '"'}
+                    if self.headers.get('If-None-Match') == headers['ETag']:
+                        server.not_modified += 1
+                        status, body = 304, b''
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if send_body:
+                    self.wfile.write(body)
+
+            def do_GET(self):
+                self.respond(True)
+
+            def do_HEAD(self):
+                self.respond(False)
+
+            def do_POST(self):
+                self.respond(True)
+
+            def do_PUT(self):
+                self.respond(True)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
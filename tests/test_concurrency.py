@@ -0,0 +1,76 @@
+import random
+import threading
+import time
+
+from concurrency import GIB, AdaptiveLimiter, auto_limits
+
+
+def test_auto_limits():
+    # A big daemon, but a small runner for the hooks.
+    limits = auto_limits({'NCPU': 16, 'MemTotal': 64 * GIB}, cpu_count=4, memory=4 * GIB)
+    assert limits == {'build': 8, 'hook': 2, 'push': 8}
+    # Memory bound daemon.
+    assert auto_limits({'NCPU': 16, 'MemTotal': 8 * GIB}, cpu_count=4, memory=None)['build'] == 2
+    # No daemon information; fall back to this host.
+    assert auto_limits({}, cpu_count=2, memory=16 * GIB) == {'build': 1, 'hook': 2, 'push': 2}
+
+
+def test_limiter_bounds_concurrency():
+    limiter = AdaptiveLimiter('build', 2, maximum=2)
+    peak = []
+    lock = threading.Lock()
+
+    def task():
+        with limiter.slot():
+            with lock:
+                peak.append(limiter.active)
+            time.sleep(0.01)
+
+    threads = [threading.Thread(target=task) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert max(peak) == 2
+    assert limiter.active == 0 and limiter.waiting == 0
+
+
+def test_limiter_adapts():
+    limiter = AdaptiveLimiter('build', 4)
+    limiter.waiting = 3
+    for _ in range(10):
+        limiter._observe(10)
+    assert limiter.limit == 5
+
+    limiter.waiting = 0
+    for _ in range(5):
+        limiter._observe(60)
+    assert limiter.limit == 4
+    # A lasting slowdown becomes the baseline rather than a reason to keep
+    # lowering the limit.
+    for _ in range(40):
+        limiter._observe(60)
+    assert limiter.limit >= 2
+    limiter.waiting = 3
+    for _ in range(5):
+        limiter._observe(60)
+    assert limiter.limit > 2
+
+
+def test_limiter_mixed_durations():
+    # Cached and uncached builds (or quick and slow hooks) mixed at random.
+    rng = random.Random(1)
+    limiter = AdaptiveLimiter('build', 8)
+    limiter.waiting = 4
+    for _ in range(200):
+        cached = rng.random() < 0.5
+        limiter._observe(rng.uniform(4, 6) if cached else rng.uniform(250, 350), 'cached' if cached else 'built')
+    assert limiter.limit >= 8
+
+    # A real slowdown of both kinds is still noticed.
+    limiter.waiting = 0
+    limit = limiter.limit
+    for _ in range(10):
+        cached = rng.random() < 0.5
+        limiter._observe(15 if cached else 900, 'cached' if cached else 'built')
+    assert limiter.limit < limit
@@ -0,0 +1,124 @@
+from unittest import mock
+
+from releasemanager import existing_tags, fetch_mac_eap_versions, fetch_mac_versions, fetch_pac_release_versions, manifest_digest, probe_tags, ReleaseManager
+import releasemanager
+from tests import benchmark
+from tests.mockserver import MockServer, synthetic_eap_versions, synthetic_tags, synthetic_versions
+
+
+def test_paginated_discovery():
+    versions = synthetic_versions(120)
+    tags = synthetic_tags(versions, 250)
+    with MockServer(versions, tags={'atlassian/jira': tags}, page_size=50, tags_page_size=100) as server:
+        assert set(fetch_mac_versions('jira')) == set(versions)
+        assert existing_tags('atlassian/jira') == set(tags)
+        assert existing_tags('atlassian/missing') == set()
+        tag_requests = [path for _, path in server.requests if path.endswith('/tags/list')]
+        assert len(tag_requests) == 4
+
+
+def test_eap_and_pac_discovery():
+    versions = synthetic_versions(5)
+    eap_versions = synthetic_eap_versions(3)
+    with MockServer(versions, eap_versions):
+        assert fetch_mac_eap_versions('jira-software') == sorted(eap_versions, reverse=True)
+        assert sorted(fetch_pac_release_versions('bitbucket-mesh')) == sorted(versions)
+
+
+def test_offline_release_manager(refapp):
+    versions = synthetic_versions(30)
+    tags = synthetic_tags(versions, 90, unbuilt=3)
+    with MockServer(versions, tags={'atlassian/bitbucket-server': tags}), mock.patch('releasemanager.docker.from_env'):
+        refapp['start_version'] = '1'
+        rm = ReleaseManager(**refapp)
+        assert sorted(rm.unbuilt_versions(rm.release_versions)) == ['1.2.7', '1.2.8', '1.2.9']
+
+
+def test_manifest_probes():
+    with MockServer(tags={'atlassian/jira': ['1.0.0', '1.0.1']}) as server:
+        assert manifest_digest('atlassian/jira', '1.0.0') == server.digest('atlassian/jira', '1.0.0')
+        assert manifest_digest('atlassian/jira', '9.9.9') is None
+        assert probe_tags('atlassian/jira', ['1.0.0', '1.0.1', '1.0.2']) == {'1.0.0', '1.0.1'}
+        assert all(method == 'HEAD' for method, _ in server.requests)
+
+
+def test_unbuilt_versions_strategy(refapp):
+    versions = synthetic_versions(300)
+    repos = ['atlassian/bitbucket-server', 'atlassian/bitbucket']
+    tags = synthetic_tags(versions, 900)
+    published = {repos[0]: tags, repos[1]: [t for t in tags if t != '1.0.5-ubuntu']}
+    refapp.update({'start_version': '1', 'end_version': '4', 'docker_repos': repos, 'default_release': False})
+    with MockServer(versions, tags=published) as server, mock.patch('releasemanager.docker.from_env'):
+        # A few candidates are probed individually...
+        refapp['manifest_probe_limit'] = 200
+        rm = ReleaseManager(**refapp)
+        assert rm.unbuilt_versions(['1.0.4', '1.0.5', '9.9.9']) == {'1.0.5', '9.9.9'}
+        assert not any(path.endswith('/tags/list') for _, path in server.requests)
+
+        # ...while a full range falls back to listing the repositories.
+        server.requests.clear()
+        assert rm.unbuilt_versions(rm.release_versions) == {'1.0.5'}
+        assert not any('/manifests/' in path for _, path in server.requests)
+
+
+def test_benchmark_smoke(tmp_path):
+    output = tmp_path / 'bench.json'
+    assert benchmark.main(['--scales', '10', '--repeat', '1', '--output', str(output)]) == 0
+    assert benchmark.compare({'10': {'a': 2.0}}, {'10': {'a': 1.0}}, 1.25) == [('10', 'a', 1.0, 2.0)]
+    assert benchmark.compare({'10': {'a': 1.1}}, {'10': {'a': 1.0}}, 1.25) == []
+
+
+def test_sync_aliases(refapp):
+    repo = 'atlassian/bitbucket-server'
+    versions = ['6.5.4', '6.7.7', '6.7.8', '6.8.0']
+    tags = [tag for v in versions[:3] for tag in (v, f'{v}-jdk11')]
+    refapp.update({'tag_suffixes': ['jdk11'], 'concurrent_builds': 1})
+    with MockServer(versions, tags={repo: tags}) as server, mock.patch('releasemanager.docker.from_env'):
+        for alias, source in [('6.5', '6.5.4'), ('6.5-jdk11', '6.5.4-jdk11'), ('6.7', '6.7.7'),
+                              ('6', '6.7.8'), ('latest', '6.7.8')]:
+            server.alias(repo, alias, source)
+        rm = ReleaseManager(**refapp)
+        assert rm.alias_moves(['6.5.4', '6.7.8']) == [(repo, '6.7', '6.7.8'), (repo, '6.7-jdk11', '6.7.8-jdk11')]
+
+        with mock.patch.object(ReleaseManager, 'build_releases') as build_releases:
+            rm.sync_aliases()
+        build_releases.assert_called_once_with(['6.8.0'])
+        assert server.digest(repo, '6.7') == server.digest(repo, '6.7.8')
+        assert server.digest(repo, '6.7-jdk11') == server.digest(repo, '6.7.8-jdk11')
+        assert [path for method, path in server.requests if method == 'PUT'] == [
+            f'/v2/{repo}/manifests/6.7', f'/v2/{repo}/manifests/6.7-jdk11']
+
+
+def test_sync_aliases_after_create(refapp):
+    repo = 'atlassian/bitbucket-server'
+    versions = ['6.5.4', '6.7.8', '6.8.0']
+    refapp.update({'tag_suffixes': [], 'concurrent_builds': 1})
+    with MockServer(versions, tags={repo: ['6.5.4', '6.5', '6.7.8', '6.7']}) as server, \
+            mock.patch('releasemanager.docker.from_env') as from_env:
+        docker_cli = from_env.return_value
+        pushed = lambda release, **kwargs: server.alias(repo, *[release.rpartition(':')[2]] * 2) or []
+        docker_cli.images.push.side_effect = pushed
+        rm = ReleaseManager(**refapp)
+        rm.create_releases()
+        assert docker_cli.images.build.call_count == 1
+        # The versions just pushed are not built again.
+        with mock.patch.object(ReleaseManager, 'build_releases') as build_releases:
+            rm.sync_aliases()
+        build_releases.assert_not_called()
+
+
+def test_watch(refapp, monkeypatch):
+    monkeypatch.setattr(releasemanager, 'http_cache', None)
+    repo = 'atlassian/bitbucket-server'
+    refapp.update({'start_version': '1', 'manifest_probe_limit': 200})
+    with MockServer(['1.0.0', '1.0.1', '1.0.2'], tags={repo: ['1.0.0', '1.0.1']}) as server, \
+            mock.patch('releasemanager.docker.from_env'):
+        releasemanager.enable_http_cache()
+        rm = ReleaseManager(**refapp)
+        new_release = lambda interval: server.versions.insert(0, '1.0.3')
+        with mock.patch.object(ReleaseManager, 'build_releases') as build_releases, \
+                mock.patch('releasemanager.time.sleep', side_effect=new_release):
+            rm.watch(60, create=True, create_eap=True, iterations=2)
+        assert [c.args[0] for c in build_releases.call_args_list] == [['1.0.2'], ['1.0.3']]
+        # The EAP feed didn't change between polls.
+        assert server.not_modified == 1
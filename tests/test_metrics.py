@@ -0,0 +1,92 @@
+import urllib.request
+from unittest import mock
+
+from metrics import Metrics
+from releasemanager import ReleaseManager, build_cache_stats
+from timing import EventLog, events
+
+
+def record(log, stage, duration, **fields):
+    log.record({'stage': stage, 'start': 0, 'end': duration, 'duration': duration,
+                'retries': 0, 'bytes': 0, **fields})
+
+
+def test_metrics_from_events():
+    metrics = Metrics(product='jira')
+    log = EventLog()
+    log.add_listener(metrics.observe_event)
+    record(log, 'discovery.marketplace', 0.2, bytes=1000)
+    record(log, 'build', 45, cache_hits=3, steps=5)
+    record(log, 'build', 700, retries=1, error='BuildError: broken')
+    record(log, 'push', 12, bytes=4096)
+    record(log, 'hook.post_build', 90)
+    record(log, 'unbuilt_versions', 0.01, candidates=10, skipped=8)
+
+    assert metrics.get('release_maker_builds', outcome='success') == 1
+    assert metrics.get('release_maker_builds', outcome='failure') == 1
+    assert metrics.get('release_maker_build_cache_hits') == 3
+    assert metrics.get('release_maker_retries', stage='build') == 1
+    assert metrics.get('release_maker_push_bytes') == 4096
+    assert metrics.get('release_maker_http_response_bytes', endpoint='marketplace') == 1000
+    assert metrics.get('release_maker_versions_skipped') == 8
+    counts, total, count = metrics.get('release_maker_build_duration_seconds')
+    assert count == 2 and total == 745
+    assert counts[0] == 0 and counts[-1] == 2
+
+
+@mock.patch('releasemanager.docker.from_env')
+@mock.patch('releasemanager.existing_tags', return_value=set())
+@mock.patch('releasemanager.fetch_mac_eap_versions', return_value=['6.0.0-RC2'])
+@mock.patch('releasemanager.fetch_mac_versions', return_value=['6.5.4'])
+def test_first_attempt_eap_push_not_a_retry(mocked_mac_versions, mocked_eap_versions, mocked_existing_tags, mocked_docker, refapp):
+    mocked_docker.return_value.images.push.return_value = []
+    refapp['concurrent_builds'] = 1
+    metrics = Metrics(product='bitbucket')
+    rm = ReleaseManager(**refapp)
+    events.reset()
+    with mock.patch.object(events, '_listeners', [metrics.observe_event]):
+        rm.create_eap_releases()
+    assert metrics.get('release_maker_pushes', outcome='success') > 0
+    assert (metrics.get('release_maker_retries', stage='push') or 0) == 0
+
+
+def test_render_openmetrics():
+    metrics = Metrics(product='jira')
+    metrics.inc('release_maker_pushes', outcome='success')
+    metrics.observe('release_maker_hook_duration_seconds', 3, hook='post_push')
+    text = metrics.render()
+    assert '# TYPE release_maker_pushes counter' in text
+    assert 'release_maker_pushes_total{outcome="success",product="jira"} 1' in text
+    assert 'release_maker_hook_duration_seconds_bucket{hook="post_push",le="1.0",product="jira"} 0' in text
+    assert 'release_maker_hook_duration_seconds_bucket{hook="post_push",le="5.0",product="jira"} 1' in text
+    assert 'release_maker_hook_duration_seconds_bucket{hook="post_push",le="+Inf",product="jira"} 1' in text
+    assert 'release_maker_hook_duration_seconds_count{hook="post_push",product="jira"} 1' in text
+    assert text.endswith('# EOF\n')
+
+
+def test_write_and_serve(tmp_path):
+    metrics = Metrics()
+    metrics.inc('release_maker_builds', outcome='success')
+    path = tmp_path / 'release_maker.prom'
+    metrics.write(path)
+    assert 'release_maker_last_run_timestamp_seconds' in path.read_text()
+
+    server = metrics.serve(0)
+    try:
+        port = server.server_address[1]
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics') as r:
+            assert 'release_maker_builds_total{outcome="success"} 1' in r.read().decode()
+    finally:
+        server.shutdown()
+
+
+def test_build_cache_stats():
+    build_log = [
+        {'stream': 'Step 1/3 : FROM alpine'},
+        {'stream': ' ---> 1234'},
+        {'stream': 'Step 2/3 : RUN apk add curl'},
+        {'stream': ' ---> Using cache'},
+        {'stream': 'Step 3/3 : COPY . /app'},
+        {'aux': {'ID': 'sha256:abcd'}},
+    ]
+    assert build_cache_stats(build_log) == {'steps': 3, 'cache_hits': 1}
@@ -0,0 +1,48 @@
+import concurrent.futures
+import pstats
+
+from profiling import Profiler
+from timing import EventLog
+
+
+def busy(n):
+    return sum(i * i for i in range(n))
+
+
+def test_span_tree():
+    log = EventLog()
+    with log.span('discovery'):
+        with log.span('discovery.tags', repo='atlassian/jira'):
+            pass
+    with log.context(version='1.2.3'), log.span('release'):
+        with log.span('build'):
+            pass
+        with log.span('push', tag='latest'):
+            pass
+    by_stage = {e['stage']: e for e in log.events}
+    assert by_stage['discovery.tags']['parent'] == by_stage['discovery']['id']
+    assert by_stage['build']['parent'] == by_stage['release']['id']
+    assert by_stage['push']['version'] == '1.2.3'
+    assert by_stage['release']['parent'] is None
+
+    stacks = [line.rpartition(' ')[0] for line in log.collapsed_stacks()]
+    assert 'discovery;discovery.tags' in stacks
+    assert 'release 1.2.3;build' in stacks
+    assert 'release 1.2.3;push latest' in stacks
+    assert {e['stage'] for e in log.critical_path()}.isdisjoint({'discovery', 'release'})
+
+
+def test_profiler_merges_threads(tmp_path):
+    profiler = Profiler()
+    log = EventLog()
+    with log.span('release'):
+        profiler.run(busy, 1000)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(profiler.wrap(busy), [2000, 3000]))
+
+    prefix = tmp_path / 'profile'
+    profiler.write(prefix, log)
+    stats = pstats.Stats(f'{prefix}.pstats')
+    calls = {func[2]: stat[1] for func, stat in stats.stats.items()}
+    assert calls['busy'] == 3
+    assert (tmp_path / 'profile.collapsed').read_text().startswith('release ')
@@ -1,14 +1,19 @@
 import itertools
+import json
 import logging
 import importlib
 import os
 import re
+import threading
+import time
 from unittest import mock
 
 import docker
 import pytest
 
-from releasemanager import fetch_mac_eap_versions, existing_tags, fetch_mac_versions, fetch_pac_release_versions, fetch_pac_eap_versions, ReleaseManager, str2bool, Version, latest_minor, batch_job
+from releasemanager import fetch_mac_eap_versions, existing_tags, fetch_mac_versions, fetch_pac_release_versions, fetch_pac_eap_versions, ReleaseManager, str2bool, Version, latest_minor, batch_job, read_plan, write_plan, base_images, ImageCollector, tag_priority
+import releasemanager
+from timing import events
 
 class Dict2Class(object):
     def __init__(self, my_dict):
@@ -446,6 +451,26 @@ def test_make_release_update(mocked_docker, mocked_existing_tags, mocked_mac_ver
         assert tag not in caplog.text
 
 
+def test_options_before_command():
+    parser = importlib.import_module("make-releases").build_parser()
+    before = parser.parse_args(['--push', '--concurrent-builds', '4', '--keep-going', 'execute', '--plan', 'x.json'])
+    after = parser.parse_args(['execute', '--plan', 'x.json', '--push', '--concurrent-builds', '4', '--keep-going'])
+    for args in (before, after):
+        assert (args.push_docker, args.concurrent_builds, args.keep_going) == (True, 4, True)
+    args = parser.parse_args(['--start-version', '6.5', 'plan', '--create'])
+    assert (args.start_version, args.create, args.update, args.output) == ('6.5', True, False, 'release-plan.json')
+    # Options the subcommand doesn't take still get their defaults.
+    assert parser.parse_args(['plan']).push_docker is False
+
+
+def test_hook_timeouts():
+    mr = importlib.import_module("make-releases")
+    args = mr.build_parser().parse_args(['--hook-timeout', '600', '--post-push-hook-timeout', '60'])
+    assert mr.runtime_options(args)['hook_timeouts'] == {'post_build': 600, 'post_push': 60}
+    args = mr.build_parser().parse_args(['--post-build-hook-timeout', '3600'])
+    assert mr.runtime_options(args)['hook_timeouts'] == {'post_build': 3600}
+
+
 @mock.patch('releasemanager.docker.from_env')
 @mock.patch('releasemanager.existing_tags', return_value={'5.6.7', '6.7.7', '6.0.0-RC1'})
 @mock.patch('releasemanager.fetch_mac_eap_versions', return_value={'4.0.0-RC1', '6.0.0-RC1', '6.0.0-m55', '6.0.0-RC2'})
@@ -524,9 +549,472 @@ def test_create_eap_releases_flagged(mocked_method, mocked_docker, mocked_eap_ve
 
     rm.create_eap_releases()
 
-    mocked_method.assert_any_call('docker-public.packages.atlassian.com/atlassian/bitbucket-server:6.0.0-EAP01', True)
-    mocked_method.assert_any_call('docker-public.packages.atlassian.com/atlassian/bitbucket-server:6.0.0-EAP01-jdk11', True)
-    mocked_method.assert_any_call('docker-public.packages.atlassian.com/atlassian/bitbucket-server:6.0.0-RC2', True)
-    mocked_method.assert_any_call('docker-public.packages.atlassian.com/atlassian/bitbucket-server:6.0.0-RC2-jdk11', True)
-    mocked_method.assert_any_call('docker-public.packages.atlassian.com/atlassian/bitbucket-server:6.0.0-m55', True)
+    mocked_method.assert_any_call('docker-public.packages.atlassian.com/atlassian/bitbucket-server:6.0.0-EAP01', is_prerelease=True)
+    mocked_method.assert_any_call('docker-public.packages.atlassian.com/atlassian/bitbucket-server:6.0.0-EAP01-jdk11', is_prerelease=True)
+    mocked_method.assert_any_call('docker-public.packages.atlassian.com/atlassian/bitbucket-server:6.0.0-RC2', is_prerelease=True)
+    mocked_method.assert_any_call('docker-public.packages.atlassian.com/atlassian/bitbucket-server:6.0.0-RC2-jdk11', is_prerelease=True)
+    mocked_method.assert_any_call('docker-public.packages.atlassian.com/atlassian/bitbucket-server:6.0.0-m55', is_prerelease=True)
+
+
+@mock.patch('releasemanager.run_script')
+@mock.patch('releasemanager.docker.from_env')
+@mock.patch('releasemanager.existing_tags', return_value=set())
+@mock.patch('releasemanager.fetch_mac_eap_versions', return_value=['6.0.0-RC2'])
+def test_eap_push_spans(mocked_eap_versions, mocked_existing_tags, mocked_docker, mocked_run_script, refapp):
+    mocked_docker.return_value.images.push.return_value = []
+    refapp.update({'concurrent_builds': 1, 'post_push_hook': '/push.sh'})
+    rm = ReleaseManager(**refapp)
+    events.reset()
+    rm.create_eap_releases()
+    pushes = [e for e in events.events if e['stage'] == 'push']
+    assert pushes and all(e['retries'] == 0 for e in pushes)
+    assert {c.args[2] for c in mocked_run_script.call_args_list} == {'true'}
+
+
+
+@mock.patch('releasemanager.docker.from_env')
+@mock.patch('releasemanager.existing_tags', return_value={'5.6.7', '6.7.7'})
+@mock.patch('releasemanager.fetch_mac_eap_versions', return_value=['7.0.0-RC1'])
+@mock.patch('releasemanager.fetch_mac_versions', return_value=['5.4.3', '5.6.7', '6.5.4', '6.7.7', '6.7.8'])
+def test_plan_and_execute(mocked_mac_versions, mocked_eap_versions, mocked_existing_tags, mocked_docker, tmp_path, refapp):
+    refapp['jobs_total'] = 2
+    rm = ReleaseManager(**refapp)
+    plan = rm.plan_releases(create=True, create_eap=True)
+    path = tmp_path / 'plan.json'
+    write_plan(plan, path)
+    plan = read_plan(path)
+
+    builds = {b['version']: b for b in plan['builds']}
+    assert list(builds) == ['6.7.8', '6.5.4', '7.0.0-RC1']
+    assert [b['shard'] for b in plan['builds']] == [0, 0, 1]
+    assert builds['6.7.8']['test_candidate']
+    assert 'latest' in builds['6.7.8']['tags']
+    assert builds['7.0.0-RC1']['is_prerelease']
+
+    mocked_mac_versions.reset_mock()
+    mocked_existing_tags.reset_mock()
+    executor = ReleaseManager(**plan['config'], concurrent_builds=1, push_docker=True,
+                              post_build_hook=None, post_push_hook=None,
+                              job_offset=0, jobs_total=plan['jobs_total'], plan=plan)
+    mocked_mac_versions.assert_not_called()
+    mocked_existing_tags.assert_not_called()
+    with mock.patch.object(ReleaseManager, '_push_release') as mocked_push:
+        executor.execute_plan()
+    pushed = {c.args[0].rpartition(':')[2] for c in mocked_push.call_args_list}
+    assert pushed == set(builds['6.7.8']['tags']) | set(builds['6.5.4']['tags'])
+
+
+def test_base_images():
+    dockerfile = """
+ARG BASE_IMAGE=eclipse-temurin:11
+ARG ALPINE_TAG
+FROM --platform=linux/amd64 ${BASE_IMAGE} AS base
+ARG JIRA_VERSION
+FROM base AS build
+FROM \\
+    alpine:${ALPINE_TAG:-3.18}
+FROM scratch
+FROM $BASE_IMAGE
+"""
+    assert base_images(dockerfile, {'JIRA_VERSION': '9.4.0'}) == ['eclipse-temurin:11', 'alpine:3.18']
+    assert base_images(dockerfile, {'BASE_IMAGE': 'ubuntu:22.04', 'ALPINE_TAG': '3.19'}) == ['ubuntu:22.04', 'alpine:3.19']
+
+    dockerfile = 'ARG REG=docker.io\nARG BASE=${REG}/eclipse-temurin:17\nFROM $BASE\n'
+    assert base_images(dockerfile, {}) == ['docker.io/eclipse-temurin:17']
+    assert base_images(dockerfile, {'REG': 'mirror.local'}) == ['mirror.local/eclipse-temurin:17']
+    assert base_images(dockerfile, {'BASE': 'ubuntu:22.04'}) == ['ubuntu:22.04']
+
+
+@mock.patch('releasemanager.docker.from_env')
+@mock.patch('releasemanager.existing_tags', return_value=set())
+@mock.patch('releasemanager.fetch_mac_eap_versions', return_value=[])
+@mock.patch('releasemanager.fetch_mac_versions', return_value=['6.5.4', '6.7.7', '6.7.8'])
+def test_prepull_base_images(mocked_mac_versions, mocked_eap_versions, mocked_existing_tags, mocked_docker, tmp_path, monkeypatch, refapp):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'Dockerfile').write_text(
+        'ARG BASE_IMAGE=eclipse-temurin:11\n'
+        'ARG BITBUCKET_VERSION\n'
+        'FROM ${BASE_IMAGE}\n'
+    )
+    refapp['dockerfile_buildargs'] = 'BASE_IMAGE=eclipse-temurin:17'
+    rm = ReleaseManager(**refapp)
+    rm.build_releases(['6.5.4', '6.7.7', '6.7.8'])
+    rm.docker_cli.images.pull.assert_called_once_with('eclipse-temurin', tag='17')
+    assert rm.docker_cli.images.build.call_count == 3
 
+
+@mock.patch('releasemanager.docker.from_env')
+@mock.patch('releasemanager.existing_tags', return_value=set())
+@mock.patch('releasemanager.fetch_mac_eap_versions', return_value=[])
+@mock.patch('releasemanager.fetch_mac_versions', return_value=['6.5.4', '6.7.7', '6.7.8'])
+def test_gc_images(mocked_mac_versions, mocked_eap_versions, mocked_existing_tags, mocked_docker, refapp):
+    refapp.update({'concurrent_builds': 1, 'gc_images': True, 'gc_high_water': 1000})
+    rm = ReleaseManager(**refapp)
+    image = rm.docker_cli.images.build.return_value[0]
+    image.id = 'sha256:abc'
+    rm.docker_cli.images.build.return_value = (image, [])
+    rm.docker_cli.df.return_value = {'LayersSize': 5000}
+    with mock.patch.object(ReleaseManager, '_push_release'):
+        rm.build_releases(['6.7.7', '6.7.8'])
+
+    removed = [c.args[0] for c in rm.docker_cli.images.remove.call_args_list]
+    repo = f'docker-public.packages.atlassian.com/{refapp["docker_repos"][0]}'
+    assert f'{repo}:6.7.7' in removed and f'{repo}:6.7.8' in removed and f'{repo}:latest' in removed
+    assert removed.count('sha256:abc') == 2
+    assert all(c.kwargs == {'noprune': True} for c in rm.docker_cli.images.remove.call_args_list)
+    rm.docker_cli.images.prune.assert_called_once_with(filters={'dangling': True})
+    # The storage was checked after the first version only.
+    rm.docker_cli.df.assert_called_once()
+
+
+@mock.patch('releasemanager.time.monotonic')
+def test_gc_check_interval(mocked_monotonic):
+    docker_cli = mock.Mock()
+    docker_cli.df.side_effect = [{'LayersSize': 10}, {'LayersSize': 100}]
+    collector = ImageCollector(docker_cli, high_water=50, check_interval=60)
+    for now in (0, 30, 59):
+        mocked_monotonic.return_value = now
+        collector.collect()
+    assert docker_cli.df.call_count == 1
+    mocked_monotonic.return_value = 61
+    collector.collect()
+    assert docker_cli.df.call_count == 2
+    docker_cli.images.prune.assert_called_once()
+
+
+def test_gc_prune_waits_for_builds():
+    docker_cli = mock.Mock()
+    docker_cli.df.return_value = {'LayersSize': 100}
+    collector = ImageCollector(docker_cli, high_water=10)
+    started = threading.Event()
+    finish = threading.Event()
+
+    def build():
+        with collector.building():
+            started.set()
+            finish.wait()
+
+    builder = threading.Thread(target=build)
+    builder.start()
+    started.wait()
+    pruner = threading.Thread(target=collector.collect)
+    pruner.start()
+    pruner.join(0.2)
+    docker_cli.images.prune.assert_not_called()
+    finish.set()
+    pruner.join()
+    builder.join()
+    docker_cli.images.prune.assert_called_once()
+
+
+@mock.patch('releasemanager.docker.from_env')
+@mock.patch('releasemanager.existing_tags', return_value=set())
+@mock.patch('releasemanager.fetch_mac_eap_versions', return_value=[])
+@mock.patch('releasemanager.fetch_mac_versions', return_value=['6.5.4', '6.5.5', '6.7.7', '6.7.8', '6.8.0', '7.0.0', '7.0.1'])
+def test_build_priority(mocked_mac_versions, mocked_eap_versions, mocked_existing_tags, mocked_docker, refapp):
+    refapp.update({'concurrent_builds': 1, 'end_version': '8'})
+    expected = ['7.0.1', '6.8.0', '6.7.8', '6.5.5', '7.0.0', '6.7.7', '6.5.4']
+    for default_release in (True, False):
+        refapp['default_release'] = default_release
+        rm = ReleaseManager(**refapp)
+        assert rm.prioritise(sorted(rm.release_versions)) == expected
+
+    built = []
+    rm.docker_cli.images.build.side_effect = lambda **kwargs: built.append(kwargs['buildargs']['BITBUCKET_VERSION']) or (mock.Mock(), [])
+    with mock.patch.object(ReleaseManager, '_push_release'):
+        rm.build_releases(['6.5.4', '7.0.1', '6.7.8'])
+    assert built == ['7.0.1', '6.7.8', '6.5.4']
+
+    assert tag_priority('8.0.0-RC1', {'8.0.0-RC1', 'eap'}) == 0
+    assert tag_priority('6.7.8', {'6.7.8-jdk11', '6.7-jdk11'}, {'jdk11'}) == 2
+
+
+@mock.patch('releasemanager.docker.from_env')
+@mock.patch('releasemanager.existing_tags', return_value=set())
+@mock.patch('releasemanager.fetch_mac_eap_versions', return_value=[])
+@mock.patch('releasemanager.fetch_mac_versions', return_value=['6.5.4', '6.7.7', '6.7.8'])
+def test_auto_concurrency(mocked_mac_versions, mocked_eap_versions, mocked_existing_tags, mocked_docker, refapp):
+    mocked_docker.return_value.info.return_value = {'NCPU': 8, 'MemTotal': 32 * 1024**3}
+    refapp['concurrent_builds'] = 'auto'
+    rm = ReleaseManager(**refapp)
+    assert rm.limiters['build'].limit == 4
+    assert rm.concurrent_builds == 16
+    assert rm.limiters['hook.post_build'] is not rm.limiters['hook.post_push']
+    with mock.patch.object(ReleaseManager, '_push_release'):
+        rm.build_releases(rm.release_versions)
+    assert rm.docker_cli.images.build.call_count == 3
+    assert rm.limiters['build'].active == 0
+
+
+@mock.patch('releasemanager.run_script')
+@mock.patch('daemons.docker.DockerClient')
+@mock.patch('releasemanager.existing_tags', return_value=set())
+@mock.patch('releasemanager.fetch_mac_eap_versions', return_value=[])
+@mock.patch('releasemanager.fetch_mac_versions', return_value=['6.5.4', '6.6.0', '6.7.7', '6.7.8'])
+def test_docker_hosts(mocked_mac_versions, mocked_eap_versions, mocked_existing_tags, mocked_client, mocked_run_script, refapp):
+    hosts = ['unix:///run/docker-1.sock', 'unix:///run/docker-2.sock']
+    clients = {}
+    built = {host: [] for host in hosts}
+
+    def client(base_url, max_pool_size):
+        def build(**kwargs):
+            time.sleep(0.05)
+            built[base_url].append(kwargs['buildargs']['BITBUCKET_VERSION'])
+            return mock.Mock(id=base_url), []
+        cli = clients[base_url] = mock.Mock()
+        cli.images.build.side_effect = build
+        cli.images.push.return_value = []
+        return cli
+    mocked_client.side_effect = client
+
+    refapp.update({'docker_hosts': hosts, 'post_build_hook': '/hook.sh', 'hook_timeouts': {'post_push': 60}})
+    rm = ReleaseManager(**refapp)
+    rm.build_releases(rm.release_versions)
+
+    assert all(built.values())
+    assert sorted(built[hosts[0]] + built[hosts[1]]) == sorted(rm.release_versions)
+    # Each image was pushed from, and its hook pointed at, the daemon that built it.
+    for host in hosts:
+        expected = sum(len(rm.release_tags[v]) for v in built[host])
+        assert clients[host].images.push.call_count == expected
+    assert mocked_run_script.call_count == 4
+    for call in mocked_run_script.call_args_list:
+        assert call.kwargs['env']['DOCKER_HOST'] == call.args[1]
+        assert call.kwargs['timeout'] is None
+
+
+@mock.patch('releasemanager.run_script')
+@mock.patch('releasemanager.docker.from_env')
+@mock.patch('releasemanager.existing_tags', return_value=set())
+@mock.patch('releasemanager.fetch_mac_eap_versions', return_value=[])
+@mock.patch('releasemanager.fetch_mac_versions', return_value=['6.5.4', '6.7.8'])
+def test_resume_from_journal(mocked_mac_versions, mocked_eap_versions, mocked_existing_tags, mocked_docker, mocked_run_script, tmp_path, monkeypatch, refapp):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'Dockerfile').write_text('FROM scratch\n')
+    docker_cli = mocked_docker.return_value
+    docker_cli.images.build.return_value = (mock.Mock(id='sha256:image'), [])
+    docker_cli.images.get.return_value = mock.Mock(id='sha256:image')
+    docker_cli.images.push.return_value = []
+    refapp.update({'concurrent_builds': 1, 'post_build_hook': '/build.sh', 'post_push_hook': '/push.sh',
+                   'journal': str(tmp_path / 'journal.jsonl')})
+    failing = 'docker-public.packages.atlassian.com/atlassian/bitbucket-server:6.5.4'
+
+    def hook(script, *args, **kwargs):
+        if args[0] == failing and mocked_run_script.fail:
+            raise releasemanager.TestFailedException('flaky')
+    mocked_run_script.side_effect = hook
+    mocked_run_script.fail = True
+
+    rm = ReleaseManager(**refapp)
+    with pytest.raises(releasemanager.TestFailedException):
+        rm.build_releases(rm.release_versions)
+    first_pushes = [c.args[0] for c in docker_cli.images.push.call_args_list]
+    assert docker_cli.images.build.call_count == 2
+    assert failing in first_pushes
+
+    docker_cli.reset_mock()
+    mocked_run_script.reset_mock()
+    mocked_run_script.fail = False
+    refapp['resume'] = True
+    rm = ReleaseManager(**refapp)
+    rm.build_releases(rm.release_versions)
+    second_pushes = [c.args[0] for c in docker_cli.images.push.call_args_list]
+    docker_cli.images.build.assert_not_called()
+    all_releases = {f'docker-public.packages.atlassian.com/atlassian/bitbucket-server:{t}'
+                    for v in rm.release_versions for t in rm.release_tags[v]}
+    assert sorted(first_pushes + second_pushes) == sorted(all_releases)
+    # The post-build hooks passed already; of the post-push hooks, only the
+    # failed one and those of the tags that weren't pushed yet are run.
+    hooks = [c.args for c in mocked_run_script.call_args_list]
+    assert sorted(hooks) == sorted(('/push.sh', release, 'false') for release in [failing] + second_pushes)
+
+
+@mock.patch('releasemanager.run_script')
+@mock.patch('releasemanager.docker.from_env')
+@mock.patch('releasemanager.existing_tags', return_value=set())
+@mock.patch('releasemanager.fetch_mac_eap_versions', return_value=[])
+@mock.patch('releasemanager.fetch_mac_versions', return_value=['6.5.4', '6.7.7', '6.7.8'])
+def test_keep_going(mocked_mac_versions, mocked_eap_versions, mocked_existing_tags, mocked_docker, mocked_run_script, tmp_path, refapp):
+    docker_cli = mocked_docker.return_value
+    docker_cli.images.build.side_effect = lambda **kwargs: (mock.Mock(id=kwargs['buildargs']['BITBUCKET_VERSION']), [])
+    docker_cli.images.push.return_value = []
+
+    def hook(script, *args, **kwargs):
+        if args[0] == '6.7.7':
+            raise releasemanager.TestFailedException('func tests failed')
+    mocked_run_script.side_effect = hook
+    refapp.update({'post_build_hook': '/build.sh', 'keep_going': True})
+
+    rm = ReleaseManager(**refapp)
+    rm.build_releases(rm.release_versions)
+    pushed = {c.args[0].rpartition(':')[2] for c in docker_cli.images.push.call_args_list}
+    assert {'6.5.4', '6.7.8'} <= pushed
+    assert '6.7.7' not in pushed
+    assert rm.failures == [{'version': '6.7.7', 'variant': None, 'prerelease': False, 'stage': 'post_build', 'repo': None,
+                            'tag': None, 'error': 'TestFailedException: func tests failed'}]
+
+    report = tmp_path / 'failures.json'
+    with pytest.raises(releasemanager.ReleaseFailedException):
+        rm.check_failures(report)
+    assert json.loads(report.read_text())['failed'] == 1
+
+
+@mock.patch('releasemanager.docker.from_env')
+@mock.patch('releasemanager.existing_tags', return_value={'6.5.4', '6.5.4-jdk11'})
+@mock.patch('releasemanager.fetch_mac_eap_versions', return_value=[])
+@mock.patch('releasemanager.fetch_mac_versions', return_value=['6.5.4', '6.7.8'])
+def test_release_variants(mocked_mac_versions, mocked_eap_versions, mocked_existing_tags, mocked_docker, refapp):
+    docker_cli = mocked_docker.return_value
+    built = []
+    docker_cli.images.build.side_effect = lambda **kwargs: built.append(
+        (kwargs['buildargs']['BITBUCKET_VERSION'], kwargs['dockerfile'])) or (mock.Mock(), [])
+    docker_cli.images.push.return_value = []
+    variants = [{'dockerfile': 'Dockerfile', 'tag_suffixes': ['jdk11']},
+                {'dockerfile': 'Dockerfile.ubi', 'tag_suffixes': 'ubi9', 'default_release': False}]
+
+    rm = ReleaseManager(**refapp)
+    rm.release_variants(variants, create=True)
+    # Discovery and the registry listing were shared by both variants.
+    assert mocked_mac_versions.call_count == 1
+    assert mocked_existing_tags.call_count == 1
+    # 6.5.4 only needs its ubi variant; each version's variants are built in order.
+    assert sorted(built) == [('6.5.4', 'Dockerfile.ubi'), ('6.7.8', 'Dockerfile'), ('6.7.8', 'Dockerfile.ubi')]
+    assert built.index(('6.7.8', 'Dockerfile')) < built.index(('6.7.8', 'Dockerfile.ubi'))
+    pushed = {c.args[0].rpartition(':')[2] for c in docker_cli.images.push.call_args_list}
+    assert {'latest', '6.7.8', '6.7.8-jdk11', '6.7.8-ubi9', '6.5.4-ubi9', 'ubi9'} <= pushed
+    assert '6.5.4' not in pushed
+    assert rm.tag_suffixes == {'jdk11', 'ubuntu'}
+
+
+def test_run_script_timeout(tmp_path):
+    script = tmp_path / 'hook.sh'
+    script.write_text('#!/bin/sh\necho started\nsleep 300 &\necho $! > "$1"\nwait\n')
+    script.chmod(0o755)
+    pid_file = tmp_path / 'child.pid'
+    log_path = tmp_path / 'hooks' / '6.5.4.log'
+    log_path.parent.mkdir()
+
+    start = time.monotonic()
+    with pytest.raises(releasemanager.HookTimeoutException):
+        releasemanager.run_script(str(script), str(pid_file), timeout=1, log_path=str(log_path))
+    assert time.monotonic() - start < 10
+    # The hook's children were killed along with it.
+    child = int(pid_file.read_text())
+    with pytest.raises(ProcessLookupError):
+        for _ in range(50):
+            os.kill(child, 0)
+            time.sleep(0.1)
+    assert log_path.read_text().splitlines()[1:] == ['started']
+
+
+def test_run_script_background_child(tmp_path):
+    script = tmp_path / 'hook.sh'
+    script.write_text('#!/bin/sh\necho started\n(sleep 0.2; echo late; sleep 300) &\necho $! > "$1"\n')
+    script.chmod(0o755)
+    pid_file = tmp_path / 'child.pid'
+    log_path = tmp_path / '6.5.4.log'
+
+    start = time.monotonic()
+    releasemanager.run_script(str(script), str(pid_file), log_path=str(log_path))
+    assert time.monotonic() - start < releasemanager.HOOK_KILL_GRACE
+    # The leftover child was killed, once its output had been written.
+    child = int(pid_file.read_text())
+    with pytest.raises(ProcessLookupError):
+        for _ in range(50):
+            os.kill(child, 0)
+            time.sleep(0.1)
+    assert log_path.read_text().splitlines()[1:] == ['started', 'late']
+
+
+def test_run_script_interrupted(tmp_path):
+    script = tmp_path / 'hook.sh'
+    script.write_text('#!/bin/sh\nsleep 300 &\necho $! > "$1"\nwait\n')
+    script.chmod(0o755)
+    pid_file = tmp_path / 'child.pid'
+    popen_wait = releasemanager.subprocess.Popen.wait
+    interrupts = []
+
+    def interrupted(proc, timeout=None):
+        if interrupts:
+            return popen_wait(proc, timeout)
+        interrupts.append(proc)
+        for _ in range(50):
+            if pid_file.exists() and pid_file.read_text().strip():
+                break
+            time.sleep(0.1)
+        raise KeyboardInterrupt()
+
+    with mock.patch.object(releasemanager.subprocess.Popen, 'wait', interrupted), \
+            pytest.raises(KeyboardInterrupt):
+        releasemanager.run_script(str(script), str(pid_file))
+    # The hook's process group was killed on the way out.
+    child = int(pid_file.read_text())
+    with pytest.raises(ProcessLookupError):
+        for _ in range(50):
+            os.kill(child, 0)
+            time.sleep(0.1)
+
+
+def test_run_script_output_tail(tmp_path, caplog):
+    script = tmp_path / 'hook.sh'
+    script.write_text('#!/bin/sh\nfor i in $(seq 1 200); do echo "line $i"; done\nexit 3\n')
+    script.chmod(0o755)
+    log_path = tmp_path / '6.5.4.log'
+
+    with caplog.at_level(logging.ERROR), pytest.raises(releasemanager.TestFailedException) as exc:
+        releasemanager.run_script(str(script), log_path=str(log_path))
+    assert not isinstance(exc.value, releasemanager.HookTimeoutException)
+    # The full output goes to the log file, and only a bounded tail is kept.
+    assert len(log_path.read_text().splitlines()) == 201
+    tail = next(r.message for r in caplog.records if r.message.startswith('Last '))
+    assert tail.splitlines()[1:] == [f'line {i}' for i in range(151, 201)]
+
+
+@mock.patch('releasemanager.docker.from_env')
+@mock.patch('releasemanager.existing_tags', return_value=set())
+@mock.patch('releasemanager.fetch_mac_eap_versions', return_value=[])
+@mock.patch('releasemanager.fetch_mac_versions', return_value=['6.5.4', '6.7.8'])
+def test_variants_prepull_shared_base_images(mocked_mac_versions, mocked_eap_versions, mocked_existing_tags, mocked_docker, tmp_path, monkeypatch, refapp):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'Dockerfile').write_text('FROM eclipse-temurin:17\n')
+    (tmp_path / 'Dockerfile.ubi').write_text('FROM eclipse-temurin:17 AS jdk\nFROM redhat/ubi9\n')
+    docker_cli = mocked_docker.return_value
+    docker_cli.images.build.return_value = (mock.Mock(), [])
+    docker_cli.images.push.return_value = []
+    refapp['concurrent_builds'] = 2
+    variants = [{'tag_suffixes': ['jdk17']}, {'dockerfile': 'Dockerfile.ubi', 'tag_suffixes': ['ubi9']}]
+
+    rm = ReleaseManager(**refapp)
+    rm.release_variants(variants, create=True)
+    assert docker_cli.images.build.call_count == 4
+    pulls = sorted((c.args[0], c.kwargs['tag']) for c in docker_cli.images.pull.call_args_list)
+    assert pulls == [('eclipse-temurin', '17'), ('redhat/ubi9', 'latest')]
+
+
+@mock.patch('daemons.docker.DockerClient')
+@mock.patch('releasemanager.existing_tags', return_value=set())
+@mock.patch('releasemanager.fetch_mac_eap_versions', return_value=[])
+@mock.patch('releasemanager.fetch_mac_versions', return_value=['6.5.4', '6.6.0', '6.7.7', '6.7.8'])
+def test_variants_share_daemon(mocked_mac_versions, mocked_eap_versions, mocked_existing_tags, mocked_client, refapp):
+    hosts = ['unix:///run/docker-1.sock', 'unix:///run/docker-2.sock']
+    built = {}
+
+    def client(base_url, max_pool_size):
+        def build(**kwargs):
+            built.setdefault(kwargs['buildargs']['BITBUCKET_VERSION'], []).append(base_url)
+            # Other work lands on this daemon while the version is in progress.
+            daemon = next(d for d in rm.daemons.daemons if d.name == base_url)
+            daemon.active += 5 if kwargs['dockerfile'] == 'Dockerfile' else -5
+            return mock.Mock(id=base_url), []
+        cli = mock.Mock()
+        cli.images.build.side_effect = build
+        cli.images.push.return_value = []
+        return cli
+    mocked_client.side_effect = client
+
+    refapp.update({'docker_hosts': hosts, 'concurrent_builds': 1})
+    rm = ReleaseManager(**refapp)
+    rm.release_variants([{'dockerfile': 'Dockerfile', 'tag_suffixes': ['jdk11']},
+                         {'dockerfile': 'Dockerfile.ubi', 'tag_suffixes': ['ubi9']}], create=True)
+    assert sorted(built) == sorted(rm.release_versions)
+    assert all(len(daemons) == 2 and len(set(daemons)) == 1 for daemons in built.values())
@@ -0,0 +1,63 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import snyk
+from releasemanager import Registry
+from tests.mockserver import MockServer
+
+
+def test_no_registry_credentials_needed():
+    env = {k: v for k, v in os.environ.items() if not k.startswith('DOCKER_BOT_')}
+    code = 'import releasemanager, snyk; print(releasemanager.registry_url("/v2/"))'
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.run([sys.executable, '-c', code], env=env, cwd=root, capture_output=True, text=True, check=True)
+    assert proc.stdout.strip() == f'https://{Registry.DOCKER_REGISTRY}/v2/'
+
+
+def test_projects_for():
+    assert snyk.projects_for(None) == snyk.DEFAULT_PROJECTS
+    assert snyk.projects_for('bitbucket-server') == ['bitbucket', 'bitbucket-server']
+    assert snyk.projects_for('jira-servicedesk') == ['jira-servicemanagement', 'jira-servicedesk']
+    assert snyk.projects_for('jira-core') == ['jira-core', 'jira-software', 'jira-servicemanagement', 'jira-servicedesk']
+    assert snyk.projects_for('bamboo-agent-base') == ['bamboo-agent-base']
+    with pytest.raises(ValueError):
+        snyk.projects_for('hipchat')
+
+
+def test_select_tags():
+    tags = ['7.0.0', '7.0.0-ubuntu', '8.1.0', '8.1.0-ubuntu', 'latest', 'ubuntu']
+    assert snyk.select_tags(tags, regex_tag='^ubuntu$') == ['ubuntu']
+    assert snyk.select_tags(tags, before_version='8') == ['7.0.0', '7.0.0-ubuntu']
+    assert snyk.select_tags(tags, regex_tag='ubuntu', before_version='8') == ['7.0.0-ubuntu']
+    # Tags that only start like a version are left alone.
+    assert snyk.select_tags(tags + ['7.13.0_ubuntu', '7x'], before_version='8') == ['7.0.0', '7.0.0-ubuntu']
+
+
+def test_rate_limiter():
+    limiter = snyk.RateLimiter(100)
+    start = time.monotonic()
+    for _ in range(6):
+        limiter.wait()
+    assert time.monotonic() - start >= 0.05
+
+
+def test_untag():
+    tags = {'atlassian/confluence': ['7.0.0', '8.0.0'], 'atlassian/confluence-server': ['7.0.0', '7.1.0', 'ubuntu']}
+    with MockServer(tags=tags) as server:
+        names = [f'{Registry.DOCKER_REGISTRY}/atlassian/{project}' for project in
+                 ['confluence:7.0.0', 'confluence-server:7.0.0', 'confluence-server:7.1.0']]
+        assert snyk.snyk_project_names(['confluence', 'confluence-server'], before_version='8') == names
+
+        server.snyk_projects = {names[0]: 'p1', names[2]: 'p3', 'something-else': 'p9'}
+        args = argparse.Namespace(project='confluence', regex_tag=None, before_version='8', yes=True,
+                                  token='secret', org_id='org', snyk_api=server.snyk_api, rate=0, concurrency=4,
+                                  tag_key='team-name', tag_value='dc-deployment')
+        assert set(snyk.untag(args)) == {names[0], names[2]}
+        assert sorted(server.untagged) == [('p1', 'team-name', 'dc-deployment'), ('p3', 'team-name', 'dc-deployment')]
+        project_lists = [path for method, path in server.requests if path.endswith('/projects')]
+        assert project_lists == ['/snyk/org/org/projects']
@@ -0,0 +1,82 @@
+import json
+
+import pytest
+
+from releasemanager import pushed_bytes
+from timing import EventLog
+
+
+def test_span_records_fields():
+    log = EventLog()
+    with log.context(version='6.7.8'):
+        with log.span('push', repo='atlassian/jira', tag='latest') as event:
+            event['bytes'] = 1024
+    assert len(log.events) == 1
+    event = log.events[0]
+    assert event['stage'] == 'push'
+    assert event['version'] == '6.7.8'
+    assert event['repo'] == 'atlassian/jira'
+    assert event['tag'] == 'latest'
+    assert event['bytes'] == 1024
+    assert event['end'] >= event['start']
+
+
+def test_span_records_errors():
+    log = EventLog()
+    with pytest.raises(ValueError):
+        with log.span('build', version='1.2.3'):
+            raise ValueError('broken')
+    assert log.events[0]['error'] == 'ValueError: broken'
+    assert log.stage_totals()['build']['errors'] == 1
+
+
+def test_event_log_file(tmp_path):
+    path = tmp_path / 'events.jsonl'
+    log = EventLog()
+    log.open(path)
+    with log.span('discovery.eap'):
+        pass
+    with log.span('build', version='1.2.3', retries=2):
+        pass
+    log.close()
+    lines = [json.loads(l) for l in path.read_text().splitlines()]
+    assert [l['stage'] for l in lines] == ['discovery.eap', 'build']
+    assert lines[1]['retries'] == 2
+
+
+def test_critical_path():
+    log = EventLog()
+    for stage, version, start, end in [('discovery.tags', None, 0, 1),
+                                       ('build', '1.0.0', 1, 5),
+                                       ('build', '1.0.1', 1, 3),
+                                       ('push', '1.0.1', 3, 4),
+                                       ('push', '1.0.0', 5, 6)]:
+        log.record({'stage': stage, 'version': version, 'start': start, 'end': end,
+                    'duration': end - start, 'retries': 0, 'bytes': 0})
+    path = [(e['stage'], e['version']) for e in log.critical_path()]
+    assert path == [('discovery.tags', None), ('build', '1.0.0'), ('push', '1.0.0')]
+    assert 'Critical path (6.00s of 6.00s wall-clock)' in log.summary()
+
+
+def test_summary_slowest_hooks():
+    log = EventLog()
+    for stage, tag, duration, timed_out in [('hook.post_build', None, 30, False),
+                                            ('hook.post_push', 'latest', 600, True),
+                                            ('hook.post_push', '6.5.4', 2, False)]:
+        log.record({'stage': stage, 'version': '6.5.4', 'tag': tag, 'start': 0, 'end': duration,
+                    'duration': duration, 'retries': 0, 'bytes': 0, 'timed_out': timed_out})
+    hooks = log.summary().split('Slowest hooks:\n')[1].splitlines()
+    assert [line.split()[1] for line in hooks] == ['hook.post_push', 'hook.post_build', 'hook.post_push']
+    assert hooks[0].endswith('6.5.4 latest  (timed out)')
+
+
+def test_pushed_bytes():
+    progress = [
+        {'status': 'Preparing', 'id': 'a'},
+        {'status': 'Pushing', 'id': 'a', 'progressDetail': {'current': 512, 'total': 2048}},
+        {'status': 'Pushing', 'id': 'a', 'progressDetail': {'current': 2048, 'total': 2048}},
+        {'status': 'Layer already exists', 'id': 'b', 'progressDetail': {}},
+        {'status': 'Pushing', 'id': 'c', 'progressDetail': {'current': 100, 'total': 100}},
+        {'status': 'latest: digest: sha256:abc size: 1234'},
+    ]
+    assert pushed_bytes(progress) == 2148
@@ -0,0 +1,178 @@
+import contextlib
+import itertools
+import json
+import logging
+import threading
+import time
+
+# Number of hook runs listed in the summary.
+SLOW_HOOKS = 5
+
+
+def _subject(event):
+    return ' '.join(str(event[k]) for k in ('version', 'repo', 'tag') if event.get(k))
+
+
+class EventLog:
+
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+        self._file = None
+        self._local = threading.local()
+        self._listeners = []
+        self._ids = itertools.count(1)
+
+    def open(self, path):
+        self.close()
+        logging.info(f'Writing stage events to {path}')
+        self._file = open(path, 'a')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def reset(self):
+        with self._lock:
+            self.events = []
+
+    @contextlib.contextmanager
+    def context(self, **fields):
+        # Fields set here (e.g. the version being released) are applied to
+        # every span opened by the same thread until the block exits.
+        previous = getattr(self._local, 'fields', {})
+        self._local.fields = {**previous, **fields}
+        try:
+            yield
+        finally:
+            self._local.fields = previous
+
+    @contextlib.contextmanager
+    def span(self, stage, **fields):
+        # The yielded event is mutable so that callers can fill in
+        # retries/bytes (or anything else) as the stage progresses.
+        # Spans opened while another is active on the same thread become its
+        # children, which gives the per-version span tree used by profiling.
+        stack = self._local.__dict__.setdefault('stack', [])
+        event = {'stage': stage, 'version': None, 'repo': None, 'tag': None,
+                 'retries': 0, 'bytes': 0,
+                 **getattr(self._local, 'fields', {}), **fields,
+                 'id': next(self._ids), 'parent': stack[-1] if stack else None}
+        stack.append(event['id'])
+        event['start'] = time.monotonic()
+        try:
+            yield event
+        except BaseException as exc:
+            event['error'] = f'{type(exc).__name__}: {exc}'
+            raise
+        finally:
+            stack.pop()
+            event['end'] = time.monotonic()
+            event['duration'] = event['end'] - event['start']
+            self.record(event)
+
+    def record(self, event):
+        with self._lock:
+            self.events.append(event)
+            if self._file is not None:
+                self._file.write(json.dumps(event, default=str) + '\n')
+                self._file.flush()
+        for listener in self._listeners:
+            listener(event)
+
+    def stage_totals(self):
+        totals = {}
+        for event in self.events:
+            total = totals.setdefault(event['stage'], {
+                'count': 0, 'total': 0.0, 'max': 0.0, 'retries': 0, 'bytes': 0, 'errors': 0,
+            })
+            total['count'] += 1
+            total['total'] += event['duration']
+            total['max'] = max(total['max'], event['duration'])
+            total['retries'] += event.get('retries', 0)
+            total['bytes'] += event.get('bytes', 0)
+            total['errors'] += 1 if 'error' in event else 0
+        return totals
+
+    def critical_path(self):
+        # Walk backwards from the last event to finish, each time picking
+        # the latest-finishing event that completed before the current one
+        # started. With concurrent builds this gives the chain of stages
+        # that actually determined the wall-clock time of the run. Only leaf
+        # spans are considered, as parents overlap their children.
+        parents = {e.get('parent') for e in self.events}
+        events = [e for e in self.events if e.get('id') is None or e['id'] not in parents]
+        if not events:
+            return []
+        path = [max(events, key=lambda e: e['end'])]
+        while True:
+            before = [e for e in events if e['end'] <= path[-1]['start']]
+            if not before:
+                break
+            path.append(max(before, key=lambda e: e['end']))
+        path.reverse()
+        return path
+
+    def collapsed_stacks(self):
+        # Brendan Gregg's collapsed-stack format ("root;child;leaf <value>"),
+        # one line per span with its self-time in milliseconds, so the span
+        # tree can be fed straight into flamegraph.pl or speedscope.
+        by_id = {e['id']: e for e in self.events if e.get('id') is not None}
+        child_time = {}
+        for event in self.events:
+            if event.get('parent') is not None:
+                child_time[event['parent']] = child_time.get(event['parent'], 0.0) + event['duration']
+        stacks = {}
+        for event in self.events:
+            frames = []
+            current = event
+            while current is not None:
+                frame = current['stage']
+                if current.get('parent') is None and current.get('version'):
+                    frame = f'{frame} {current["version"]}'
+                if current.get('tag') and current['stage'] in ('push', 'hook.post_push'):
+                    frame = f'{frame} {current["tag"]}'
+                frames.append(frame)
+                current = by_id.get(current.get('parent'))
+            stack = ';'.join(reversed(frames))
+            self_time = max(0.0, event['duration'] - child_time.get(event.get('id'), 0.0))
+            stacks[stack] = stacks.get(stack, 0.0) + self_time
+        return [f'{stack} {round(seconds * 1000)}' for stack, seconds in stacks.items()]
+
+    def summary(self):
+        if not self.events:
+            return 'No stage events recorded'
+        lines = [f'{"stage":<24} {"count":>6} {"total(s)":>10} {"mean(s)":>9} '
+                 f'{"max(s)":>9} {"retries":>8} {"bytes":>14} {"errors":>7}']
+        for stage, t in sorted(self.stage_totals().items(), key=lambda i: -i[1]['total']):
+            lines.append(f'{stage:<24} {t["count"]:>6} {t["total"]:>10.2f} '
+                         f'{t["total"] / t["count"]:>9.2f} {t["max"]:>9.2f} '
+                         f'{t["retries"]:>8} {t["bytes"]:>14} {t["errors"]:>7}')
+
+        start = min(e['start'] for e in self.events)
+        end = max(e['end'] for e in self.events)
+        path = self.critical_path()
+        lines.append('')
+        lines.append(f'Critical path ({sum(e["duration"] for e in path):.2f}s of {end - start:.2f}s wall-clock):')
+        for event in path:
+            lines.append(f'  +{event["start"] - start:>8.2f}s {event["duration"]:>8.2f}s  '
+                         f'{event["stage"]:<24} {_subject(event)}')
+
+        # A single stuck scan or test run is easy to miss in the totals.
+        hooks = sorted((e for e in self.events if e['stage'].startswith('hook.')), key=lambda e: -e['duration'])
+        if hooks:
+            lines.append('')
+            lines.append('Slowest hooks:')
+            for event in hooks[:SLOW_HOOKS]:
+                note = '  (timed out)' if event.get('timed_out') else ''
+                lines.append(f'  {event["duration"]:>8.2f}s  {event["stage"]:<24} {_subject(event)}{note}')
+        return '\n'.join(lines)
+
+
+# Shared by the discovery functions and the ReleaseManager; make-releases.py
+# opens the JSON-lines file and prints the summary at the end of the run.
+events = EventLog()